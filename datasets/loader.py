@@ -1,19 +1,283 @@
-from collections import Counter
+import hashlib
+import os
+import shutil
+import uuid
+import zipfile
+import zlib
 
 import numpy as np
 import pandas as pd
 
+# version of the parsers, to be increased when their output changes so that caches are rebuilt
+CACHE_VERSION = 2
 
-def read_sim(directory, sample_frequency):
+
+def get_trajectory_index(dataframe, features=('pos_x', 'pos_y', 'v_x', 'v_y'), dtype=None):
+    """
+    Builds a dense agent x frame x feature tensor of the measurements, so that scene data can be retrieved
+    with integer indexing instead of dataframe scans.
+    :param dataframe: dataframe to be indexed
+    :param features: columns to be stored for every agent and frame
+    :param dtype: data type of the tensor, the type of the columns if not given
+    :return: dictionary with data tensor, presence bitmap and agent/frame id to index mappings
+    """
+    agent_ids, agent_idx = np.unique(dataframe['agent_id'].values, return_inverse=True)
+    frame_ids, frame_idx = np.unique(dataframe['frame_id'].values, return_inverse=True)
+
+    values = dataframe[list(features)].to_numpy(dtype=dtype)
+    data = np.zeros((len(agent_ids), len(frame_ids), len(features)), dtype=values.dtype)
+    data[agent_idx, frame_idx] = values
+    present = np.zeros((len(agent_ids), len(frame_ids)), dtype=bool)
+    present[agent_idx, frame_idx] = True
+
+    return {
+        'data': data,
+        'present': present,
+        'agent_ids': agent_ids,
+        'frame_ids': frame_ids,
+        'agents': {agent: i for i, agent in enumerate(agent_ids)},
+        'frames': {frame: i for i, frame in enumerate(frame_ids)}
+    }
+
+
+def get_seed(seed, *keys):
+    """
+    Derive the seed of a unit of work, e.g. a chunk of a dataset, from the global seed, so that results do not depend
+    on the order in which units are processed.
+    :param seed: global seed
+    :param keys: numbers or names identifying the unit
+    :return: seed of the unit
+    """
+    spawn_key = tuple(zlib.crc32(key.encode()) if isinstance(key, str) else int(key) for key in keys)
+    seed_sequence = np.random.SeedSequence(seed, spawn_key=spawn_key)
+    return int(seed_sequence.generate_state(1)[0])
+
+
+def merge_shards(folder, shards):
+    """
+    Concatenate the .npy files of shard folders into files of the same name in folder, writing them through memory
+    maps, so that the shards do not need to fit in memory together. The shards are removed afterwards.
+    :param folder: folder of the merged files
+    :param shards: folders of the shards, in order
+    :return: nothing
+    """
+    if len(shards) == 0:
+        raise ValueError('no shards to merge into {}'.format(folder))
+    os.makedirs(folder, exist_ok=True)
+    for name in sorted(file for file in os.listdir(shards[0]) if file.endswith('.npy')):
+        arrays = [np.load('{}/{}'.format(shard, name), mmap_mode='r') for shard in shards]
+        merged = np.lib.format.open_memmap('{}/{}'.format(folder, name), mode='w+', dtype=arrays[0].dtype,
+                                           shape=(sum(len(array) for array in arrays),) + arrays[0].shape[1:])
+        start = 0
+        for array in arrays:
+            merged[start:start + len(array)] = array
+            start += len(array)
+        merged.flush()
+        del merged, arrays
+    for shard in shards:
+        shutil.rmtree(shard)
+    for shards_folder in set(os.path.dirname(shard) for shard in shards):
+        if len(os.listdir(shards_folder)) == 0:
+            os.rmdir(shards_folder)
+
+
+def get_file_hash(path):
+    """
+    Hashes the content of a file.
+    :param path: path of the file
+    :return: hex digest of the content
+    """
+    file_hash = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def read_cached(path, parse, cache=True):
+    """
+    Reads the arrays parsed from a file from a binary cache next to it, as long as the file content has the hash the
+    cache was built from. Otherwise, the file is parsed and the cache is written again.
+    :param path: path of the file
+    :param parse: function parsing the file to a dictionary of arrays
+    :param cache: True to use the cache, otherwise False
+    :return: dictionary of arrays
+    """
+    if not cache:
+        return parse(path)
+    cache_path = '{}.cache.npz'.format(path.rsplit('.', 1)[0])
+    # the parser is part of the key, as a file can be parsed in different ways
+    file_hash = '{}:{}:{}'.format(CACHE_VERSION, parse.__name__, get_file_hash(path))
+    try:
+        with np.load(cache_path) as cached:
+            if str(cached['hash']) == file_hash:
+                return {name: cached[name] for name in cached.files if name != 'hash'}
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile, EOFError):
+        # a missing, truncated or corrupt cache is a miss
+        pass
+    arrays = parse(path)
+    if any(array.dtype == object for array in arrays.values()):
+        # object arrays can only be loaded with allow_pickle, so their cache would never be read
+        return arrays
+    # the cache is written to a temporary file and moved in place, so that concurrent readers never see it half
+    # written
+    tmp_path = '{}.{}.tmp'.format(cache_path, uuid.uuid4().hex)
+    try:
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, hash=file_hash, **arrays)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return arrays
+
+
+def parse_sim(path):
+    """
+    Parses a data.csv file.
+    :param path: path of the file
+    :return: dictionary with the columns of the file
+    """
+    df = pd.read_csv(path)
+    return {column: df[column].values for column in df.columns}
+
+
+def parse_obsmat(path):
+    """
+    Parses an obsmat.txt file.
+    :param path: path of the file
+    :return: dictionary with the frame, agent, position and velocity columns of the file
     """
-    Reads a data.csv file from the given directory and converts it to a dataframe
+    columns = ['frame_id', 'agent_id', 'pos_x', 'pos_z', 'pos_y', 'v_x', 'v_z', 'v_y']
+    df = pd.read_csv(path, sep='\s+', names=columns, header=None)
+    df.drop(columns=['pos_z', 'v_z'], inplace=True)
+    # modify data types
+    df["frame_id"] = df["frame_id"].astype(int)
+    if str(df["agent_id"].iloc[0]).replace('.', '', 1).isdigit():
+        df["agent_id"] = df["agent_id"].astype(int)
+    df["pos_x"] = df["pos_x"].astype(float)
+    df["pos_y"] = df["pos_y"].astype(float)
+    return {column: df[column].values for column in df.columns}
+
+
+def find_sim_arrays(directory):
+    """
+    Finds the location and velocity arrays written by the group simulation in the given directory.
     :param directory: name of the directory
-    :return: dataframe
+    :return: paths of the loc_sim_*.npy and vel_sim_*.npy files, or None if the directory does not contain them
     """
-    df = pd.read_csv(directory + '/data.csv')
+    if not os.path.isdir(directory):
+        return None
+    for file in sorted(os.listdir(directory)):
+        if file.startswith('loc_sim_') and file.endswith('.npy'):
+            velocities = 'vel_sim_' + file[len('loc_sim_'):]
+            if os.path.exists('{}/{}'.format(directory, velocities)):
+                return '{}/{}'.format(directory, file), '{}/{}'.format(directory, velocities)
+    return None
+
+
+def get_sim_columns(locations, velocities, sims):
+    """
+    Gets the columns of simulation data from the arrays of the group simulation, in the row order of its data.csv.
+    :param locations: locations of shape [sims, frames, 2, agents]
+    :param velocities: velocities of shape [sims, frames, 2, agents]
+    :param sims: ids of the simulations
+    :return: dictionary with the columns of the simulations
+    """
+    sims_num, frames_num, _, agents_num = locations.shape
+    data = np.concatenate((np.transpose(locations, (0, 3, 1, 2)), np.transpose(velocities, (0, 3, 1, 2))), axis=3)
+    data = data.reshape(-1, 4)
+    return {
+        'pos_x': data[:, 0],
+        'pos_y': data[:, 1],
+        'v_x': data[:, 2],
+        'v_y': data[:, 3],
+        'agent_id': np.tile(np.repeat(np.arange(agents_num), frames_num), sims_num),
+        'frame_id': np.tile(np.arange(frames_num), sims_num * agents_num),
+        'sim': np.repeat(np.asarray(sims, dtype=np.int64), agents_num * frames_num)
+    }
+
+
+def get_sim_index(df, sample_frequency, fps, dtype=np.float32):
+    """
+    Builds the trajectory index of simulation data, with the frames of every simulation offset by the simulation id.
+    :param df: dataframe of one or more simulations
+    :param sample_frequency: frame ids between the start of two simulations
+    :param fps: frames per second of the simulations
+    :param dtype: data type of the measurements of the trajectory index
+    :return: trajectory index with the fps and the simulation of every frame
+    """
+    df = df.assign(frame_id=df['frame_id'] + df['sim'] * sample_frequency)
+    index = get_trajectory_index(df, dtype=dtype)
+    index['fps'] = fps
+    index['sims'] = np.zeros(len(index['frame_ids']), dtype=df['sim'].dtype)
+    index['sims'][np.searchsorted(index['frame_ids'], df['frame_id'].values)] = df['sim'].values
+    return index
+
+
+def read_sims(directory, sample_frequency, chunk_size=100000, dtype=np.float32):
+    """
+    Reads the simulations from the given directory and yields the trajectory index of one simulation at a time,
+    so that only one simulation is kept in memory. The location and velocity arrays of the group simulation are
+    read through memory maps if they exist, otherwise the data.csv file is read in chunks, with the rows of every
+    simulation expected to be contiguous, as they are written by the simulations.
+    :param directory: name of the directory
+    :param sample_frequency: frame ids between the start of two simulations
+    :param chunk_size: number of rows to read at a time
+    :param dtype: data type of the measurements of the trajectory index
+    :return: generator of (sim, trajectory index) tuples
+    """
+    arrays = find_sim_arrays(directory)
+    if arrays is not None:
+        locations, velocities = [np.load(path, mmap_mode='r') for path in arrays]
+        for sim in range(len(locations)):
+            df = pd.DataFrame(get_sim_columns(locations[sim:sim + 1], velocities[sim:sim + 1], [sim]))
+            # frames of the arrays are consecutive
+            yield sim, get_sim_index(df, sample_frequency, 1, dtype)
+        return
+
+    fps = None
+    sim_rows = []
+    for chunk in pd.read_csv(directory + '/data.csv', chunksize=chunk_size):
+        if fps is None:
+            fps = np.diff(pd.unique(chunk["frame_id"]))[0] * 1
+        sims = chunk['sim'].values
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(sims)) + 1, [len(chunk)]))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if len(sim_rows) > 0 and sim_rows[0]['sim'].iat[0] != sims[start]:
+                rows = pd.concat(sim_rows)
+                yield rows['sim'].iat[0], get_sim_index(rows, sample_frequency, fps, dtype)
+                sim_rows = []
+            sim_rows.append(chunk.iloc[start:end])
+    if len(sim_rows) > 0:
+        rows = pd.concat(sim_rows)
+        yield rows['sim'].iat[0], get_sim_index(rows, sample_frequency, fps, dtype)
+
+
+def read_sim(directory, sample_frequency, columnar=False, dtype=np.float32, cache=True):
+    """
+    Reads the location and velocity arrays of the group simulation from the given directory, or its data.csv file
+    if they do not exist, and converts them to a dataframe
+    :param directory: name of the directory
+    :param sample_frequency: frame ids between the start of two simulations
+    :param columnar: True to return a trajectory index instead of a dataframe, otherwise False
+    :param dtype: data type of the measurements of the trajectory index
+    :param cache: True to read the parsed file from its binary cache, otherwise False
+    :return: dataframe, or trajectory index with the fps and the simulation of every frame
+    """
+    arrays = find_sim_arrays(directory)
+    if arrays is not None:
+        locations, velocities = [np.load(path, mmap_mode='r') for path in arrays]
+        df = pd.DataFrame(get_sim_columns(locations, velocities, np.arange(len(locations))))
+    else:
+        df = pd.DataFrame(read_cached(directory + '/data.csv', parse_sim, cache))
 
     d_frame = np.diff(pd.unique(df["frame_id"]))
     fps = d_frame[0] * 1
+
+    if columnar:
+        return get_sim_index(df, sample_frequency, fps, dtype)
+
     df["timestamp"] = df["frame_id"] / fps
 
     df['frame_id'] += df['sim'] * sample_frequency
@@ -24,24 +288,25 @@ def read_sim(directory, sample_frequency):
     return df
 
 
-def read_obsmat(directory):
+def read_obsmat(directory, columnar=False, dtype=np.float32, cache=True):
     """
     Reads an obsmat.txt file from the given directory and converts it to a dataframe
     :param directory: name of the directory
-    :return: dataframe
+    :param columnar: True to return a trajectory index instead of a dataframe, otherwise False
+    :param dtype: data type of the measurements of the trajectory index
+    :param cache: True to read the parsed file from its binary cache, otherwise False
+    :return: dataframe, or trajectory index with the fps
     """
-    columns = ['frame_id', 'agent_id', 'pos_x', 'pos_z', 'pos_y', 'v_x', 'v_z', 'v_y']
-    df = pd.read_csv(directory + '/obsmat.txt', sep='\s+', names=columns, header=None)
-    df.drop(columns=['pos_z', 'v_z'], inplace=True)
-    # modify data types
-    df["frame_id"] = df["frame_id"].astype(int)
-    if str(df["agent_id"].iloc[0]).replace('.', '', 1).isdigit():
-        df["agent_id"] = df["agent_id"].astype(int)
-    df["pos_x"] = df["pos_x"].astype(float)
-    df["pos_y"] = df["pos_y"].astype(float)
+    df = pd.DataFrame(read_cached(directory + '/obsmat.txt', parse_obsmat, cache))
 
     d_frame = np.diff(pd.unique(df["frame_id"]))
     fps = d_frame[0] * 2.5  # 2.5 is the common annotation fps for all (ETH+UCY) datasets
+
+    if columnar:
+        index = get_trajectory_index(df, dtype=dtype)
+        index['fps'] = fps
+        return index
+
     df["timestamp"] = df["frame_id"] / fps
 
     df.sort_values(by=['agent_id', 'frame_id'], inplace=True)
@@ -50,65 +315,105 @@ def read_obsmat(directory):
     return df
 
 
-def merge_groups_with_common_agents(agents_in_multiple_groups, groups):
+def find_root(parents, agent):
+    """
+    Find the root of the set of an agent in a disjoint set forest, halving the path on the way.
+    :param parents: dictionary of the parent of every agent
+    :param agent: agent to find the root for
+    :return: root agent
     """
-    Merge groups with common agents.
-    :param agents_in_multiple_groups: list of agents that appear in multiple groups
+    while parents[agent] != agent:
+        parents[agent] = parents[parents[agent]]
+        agent = parents[agent]
+    return agent
+
+
+def merge_groups_with_common_agents(groups):
+    """
+    Merge groups with common agents, by uniting the agents of every group in a disjoint set forest.
     :param groups: list of lists representing the agent groups
-    :return: list of lists without agents being in multiple groups
+    :return: list of lists without agents being in multiple groups, groups that were not merged first and merged
+    groups with their agents in order of appearance
     """
-    for agent in agents_in_multiple_groups:
-        group_indices = []
-        for i, group in enumerate(groups):
-            if agent in group:
-                group_indices.append(i)
-        groups_to_be_merged = [groups[i] for i in group_indices]
-        merged_group = list(set(agent for group in groups_to_be_merged for agent in group))
-        for c, i in enumerate(group_indices):
-            groups.pop(i - c)
-        groups.append(merged_group)
-    return groups
+    parents = {}
+    for group in groups:
+        for agent in group:
+            parents.setdefault(agent, agent)
+            root, agent_root = find_root(parents, group[0]), find_root(parents, agent)
+            if root != agent_root:
+                parents[agent_root] = root
+
+    # groups of every set, in the order of their first group
+    set_groups = {}
+    for i, group in enumerate(groups):
+        set_groups.setdefault(find_root(parents, group[0]), []).append(i)
+
+    unmerged_groups = []
+    merged_groups = []
+    for group_indices in set_groups.values():
+        agents = [agent for i in group_indices for agent in groups[i]]
+        if len(group_indices) == 1 and len(set(agents)) == len(agents):
+            unmerged_groups.append(group_indices[0])
+        else:
+            merged_groups.append(list(dict.fromkeys(agents)))
+    return [groups[i] for i in sorted(unmerged_groups)] + merged_groups
 
 
-def read_groups(directory):
+def get_group_ids(groups, agents):
     """
-    Reads a groups.txt file from the given directory and
-    converts it to pairs of pedestrians in the same group
-    :param directory: name of the directory
-    :return: pairs
+    Map agents to the index of the group they belong to. Agents without a group get a unique negative id,
+    so that they are never considered in the same group with another agent.
+    :param groups: list of groups
+    :param agents: agent ids to be mapped
+    :return: array of group ids aligned with agents
+    """
+    agents = np.asarray(agents)
+    group_agents = np.array([agent for group in groups for agent in group], dtype=np.int64)
+    group_ids = np.repeat(np.arange(len(groups)), [len(group) for group in groups])
+    ids = -1 - np.arange(len(agents))
+    if len(group_agents) == 0 or len(agents) == 0:
+        return ids
+
+    # the last group of an agent is kept, if it is in multiple groups
+    order = np.argsort(group_agents, kind='stable')
+    group_agents = group_agents[order]
+    group_ids = group_ids[order]
+    positions = np.searchsorted(group_agents, agents, side='right') - 1
+    found = (positions >= 0) & (group_agents[np.maximum(positions, 0)] == agents)
+    ids[found] = group_ids[positions[found]]
+    return ids
+
+
+def parse_groups(path):
+    """
+    Parses a groups.txt file, merging groups with common agents.
+    :param path: path of the file
+    :return: dictionary with the size of every group and the agents of all groups
     """
 
-    with open(directory + '/groups.txt') as f:
+    with open(path) as f:
         groups = [[int(x) for x in line.split()] for line in f if not line.isspace()]
 
     # merge groups with common agents
-    count_dict = Counter([agent for group in groups for agent in group])
-    agents_in_multiple_groups = [key for key, value in count_dict.items() if value > 1]
-    if len(agents_in_multiple_groups) > 0:
-        groups_with_duplicate_agents_indices = \
-            set(i for i, group in enumerate(groups) for agent in agents_in_multiple_groups if agent in group)
-        groups_without_duplicate_agents = \
-            [group for i, group in enumerate(groups) if i not in groups_with_duplicate_agents_indices]
-        groups_with_duplicate_agents = \
-            [group for i, group in enumerate(groups) if i in groups_with_duplicate_agents_indices]
-        groups = \
-            groups_without_duplicate_agents + merge_groups_with_common_agents(agents_in_multiple_groups,
-                                                                              groups_with_duplicate_agents)
+    groups = merge_groups_with_common_agents(groups)
 
-    return groups
+    return {
+        'sizes': np.array([len(group) for group in groups], dtype=np.int64),
+        'agents': np.array([agent for group in groups for agent in group], dtype=np.int64)
+    }
 
 
-def read_multi_groups(directory):
+def parse_multi_groups(path):
     """
-    Reads a groups.txt file from the given directory and
-    converts it to pairs of pedestrians in the same group
-    :param directory: name of the directory
-    :return: pairs
+    Parses a groups.txt file with the groups of every simulation, separated by '-' lines.
+    :param path: path of the file
+    :return: dictionary with the number of groups of every simulation, the size of every group and the agents of all
+    groups
     """
 
     groups = []
     scene_groups = []
-    with open(directory + '/groups.txt') as f:
+    with open(path) as f:
         for line in f:
             if not line.isspace():
                 if line == '-\n':
@@ -117,7 +422,48 @@ def read_multi_groups(directory):
                     continue
                 scene_groups.append([int(x) for x in line.split()])
 
-    return groups
+    return {
+        'scene_sizes': np.array([len(scene_groups) for scene_groups in groups], dtype=np.int64),
+        'sizes': np.array([len(group) for scene_groups in groups for group in scene_groups], dtype=np.int64),
+        'agents': np.array([agent for scene_groups in groups for group in scene_groups for agent in group],
+                           dtype=np.int64)
+    }
+
+
+def split_groups(sizes, agents):
+    """
+    Splits the agents of all groups to lists of agents of every group.
+    :param sizes: size of every group
+    :param agents: agents of all groups
+    :return: list of lists representing the agent groups
+    """
+    return [group.tolist() for group in np.split(agents, np.cumsum(sizes)[:-1])] if len(sizes) > 0 else []
+
+
+def read_groups(directory, cache=True):
+    """
+    Reads a groups.txt file from the given directory and
+    converts it to pairs of pedestrians in the same group
+    :param directory: name of the directory
+    :param cache: True to read the parsed file from its binary cache, otherwise False
+    :return: pairs
+    """
+    arrays = read_cached(directory + '/groups.txt', parse_groups, cache)
+    return split_groups(arrays['sizes'], arrays['agents'])
+
+
+def read_multi_groups(directory, cache=True):
+    """
+    Reads a groups.txt file from the given directory and
+    converts it to pairs of pedestrians in the same group
+    :param directory: name of the directory
+    :param cache: True to read the parsed file from its binary cache, otherwise False
+    :return: pairs
+    """
+    arrays = read_cached(directory + '/groups.txt', parse_multi_groups, cache)
+    groups = split_groups(arrays['sizes'], arrays['agents'])
+    scene_starts = np.concatenate(([0], np.cumsum(arrays['scene_sizes'])))
+    return [groups[start:end] for start, end in zip(scene_starts[:-1], scene_starts[1:])]
 
 
 if __name__ == '__main__':
@@ -6,6 +6,7 @@ import random
 from collections import Counter
 from datetime import datetime
 from itertools import combinations, permutations
+from multiprocessing import Pool
 
 import numpy as np
 import pandas as pd
@@ -15,7 +16,7 @@ import xlsxwriter
 from matplotlib import pyplot as plt
 from sklearn.model_selection import train_test_split
 
-from datasets.loader import read_obsmat, read_groups
+from datasets.loader import read_obsmat, read_groups, get_trajectory_index, get_group_ids, get_seed
 
 
 def report(name, data):
@@ -83,12 +84,13 @@ def dataset_data(dataset_path):
     :param dataset_path: string of where to find dataset
     :return: dictionary with data
     """
-    df = read_obsmat(dataset_path)
+    index = read_obsmat(dataset_path, columnar=True, dtype=np.float64)
     groups = read_groups(dataset_path)
 
-    agents_num = df.agent_id.unique().size
-    frames = df.frame_id.unique()
-    frames_num = frames.size
+    agents_num = index['agent_ids'].size
+    frames_num = index['frame_ids'].size
+    # frames in the order of the measurements, which are sorted by agent and frame
+    frames = pd.unique(index['frame_ids'][np.nonzero(index['present'])[1]])
     frames_difference = frames[1] - frames[0]
 
     count_dict = Counter([agent for group in groups for agent in group])
@@ -96,28 +98,16 @@ def dataset_data(dataset_path):
     single_groups = agents_num - len(agents_in_groups)
 
     return {
-        'df': df,
+        'index': index,
         'groups': groups,
         'agents': agents_num,
         'frames': frames_num,
         'single agent groups': single_groups,
         'difference': frames_difference,
-        'duration': df.loc[df.frame_id.idxmax()]['timestamp'] - df.loc[df.frame_id.idxmin()]['timestamp']
+        'duration': index['frame_ids'][-1] / index['fps'] - index['frame_ids'][0] / index['fps']
     }
 
 
-def get_group_pairs(groups):
-    """
-    Get pairs of agents that are in same group.
-    :param groups: list of groups
-    :return: list of pairs of agents
-    """
-    pairs = []
-    for group in groups:
-        pairs.extend(list(combinations(group, 2)))
-    return pairs
-
-
 def get_no_context_group_pairs(groups):
     """
     Get pairs of agents that are in same group.
@@ -137,7 +127,7 @@ def remove_agents_in_low_number_of_frames(dataframe, agent_ids_to_be_removed):
     :param agent_ids_to_be_removed: agent ids to be removed
     :return: filtered dataframe
     """
-    return dataframe[not dataframe.agent_id.isin(agent_ids_to_be_removed)]
+    return dataframe[~dataframe.agent_id.isin(agent_ids_to_be_removed)]
 
 
 def check_for_agents_in_low_number_of_frames(dataframe, frames_threshold):
@@ -147,9 +137,8 @@ def check_for_agents_in_low_number_of_frames(dataframe, frames_threshold):
     :param frames_threshold: minimum number of frames for agent not to be removed
     :return: list of agent ids to be removed
     """
-    agents_df = dataframe.groupby('agent_id')['frame_id'].apply(list).reset_index(name='frames')
-    agents_df['frames_num'] = agents_df['frames'].apply(len)
-    return list(agents_df[agents_df['frames_num'] < frames_threshold]['agent_id'].values)
+    frames_num = dataframe.groupby('agent_id').size()
+    return list(frames_num[frames_num < frames_threshold].index.values)
 
 
 def remove_frames_with_low_number_of_agents(dataframe, frame_ids_to_be_removed):
@@ -159,7 +148,7 @@ def remove_frames_with_low_number_of_agents(dataframe, frame_ids_to_be_removed):
     :param frame_ids_to_be_removed: frames to be removed
     :return: filtered dataframe
     """
-    return dataframe[not dataframe.frame_id.isin(frame_ids_to_be_removed)]
+    return dataframe[~dataframe.frame_id.isin(frame_ids_to_be_removed)]
 
 
 def check_for_frames_with_low_number_of_agents(dataframe, agents_threshold):
@@ -169,9 +158,30 @@ def check_for_frames_with_low_number_of_agents(dataframe, agents_threshold):
     :param agents_threshold: minimum number of agents for frame not to be removed
     :return: list of frame ids to be removed
     """
-    frames_df = dataframe.groupby('frame_id')['agent_id'].apply(list).reset_index(name='agents')
-    frames_df['agents_num'] = frames_df['agents'].apply(len)
-    return list(frames_df[frames_df['agents_num'] < agents_threshold]['frame_id'].values)
+    agents_num = dataframe.groupby('frame_id').size()
+    return list(agents_num[agents_num < agents_threshold].index.values)
+
+
+def get_sufficient_data_mask(agent_codes, frame_codes, agents_threshold, frames_threshold):
+    """
+    Find the rows that remain after repeatedly removing agents with insufficient frames and frames with insufficient
+    agents. The number of rows of every agent and frame is counted once and decreased by the rows removed in each pass.
+    :param agent_codes: agent code of every row
+    :param frame_codes: frame code of every row
+    :param agents_threshold: minimum number of agents for frame not to be removed
+    :param frames_threshold: minimum number of frames for agent not to be removed
+    :return: boolean mask of the rows to keep
+    """
+    agents_num = np.bincount(frame_codes)
+    frames_num = np.bincount(agent_codes)
+    keep = np.ones(len(agent_codes), dtype=bool)
+    removed = (frames_num[agent_codes] < frames_threshold) | (agents_num[frame_codes] < agents_threshold)
+    while removed.any():
+        keep &= ~removed
+        agents_num -= np.bincount(frame_codes[removed], minlength=len(agents_num))
+        frames_num -= np.bincount(agent_codes[removed], minlength=len(frames_num))
+        removed = keep & ((frames_num[agent_codes] < frames_threshold) | (agents_num[frame_codes] < agents_threshold))
+    return keep
 
 
 def remove_agents_and_frames_with_insufficient_data(dataframe, agents_threshold, frames_threshold):
@@ -182,31 +192,41 @@ def remove_agents_and_frames_with_insufficient_data(dataframe, agents_threshold,
     :param frames_threshold: minimum number of frames for agent not to be removed
     :return: filtered dataframe
     """
-    unwanted_frame_ids = check_for_frames_with_low_number_of_agents(dataframe, agents_threshold)
-    unwanted_agent_ids = check_for_agents_in_low_number_of_frames(dataframe, frames_threshold)
-
-    while len(unwanted_frame_ids) > 0 or len(unwanted_agent_ids) > 0:
-        dataframe = dataframe[dataframe.agent_id.isin(unwanted_agent_ids) == False]
-        dataframe = dataframe[dataframe.frame_id.isin(unwanted_frame_ids) == False]
-        unwanted_frame_ids = check_for_frames_with_low_number_of_agents(dataframe, agents_threshold)
-        unwanted_agent_ids = check_for_agents_in_low_number_of_frames(dataframe, frames_threshold)
-
-    return dataframe
+    agent_codes = pd.factorize(dataframe.agent_id)[0]
+    frame_codes = pd.factorize(dataframe.frame_id)[0]
+    return dataframe[get_sufficient_data_mask(agent_codes, frame_codes, agents_threshold, frames_threshold)]
 
 
-def filter_difference_between_frame_combinations(combinations, diff_between_frames):
+def remove_index_agents_and_frames_with_insufficient_data(index, agents_threshold, frames_threshold):
     """
-    Filter frame combinations based on given difference between frames to be considered continuous.
-    :param combinations: list of frame combinations to be filtered
-    :param diff_between_frames: difference between frames to be continuous
-    :return: list of filtered frame combinations
+    Remove agents and frames with insufficient data from a trajectory index, based on given thresholds.
+    :param index: trajectory index to be filtered
+    :param agents_threshold: minimum number of agents for frame not to be removed
+    :param frames_threshold: minimum number of frames for agent not to be removed
+    :return: filtered trajectory index
     """
-    filtered_combinations = []
-    for frames in combinations:
-        differences = [True for i, frame in enumerate(frames[:-1]) if frames[i + 1] - frame != diff_between_frames]
-        if len(differences) == 0:
-            filtered_combinations.append(frames)
-    return filtered_combinations
+    agent_idx, frame_idx = np.nonzero(index['present'])
+    keep = get_sufficient_data_mask(agent_idx, frame_idx, agents_threshold, frames_threshold)
+    agent_ids, agent_idx = np.unique(agent_idx[keep], return_inverse=True)
+    frame_ids, frame_idx = np.unique(frame_idx[keep], return_inverse=True)
+
+    data = np.zeros((len(agent_ids), len(frame_ids)) + index['data'].shape[2:], dtype=index['data'].dtype)
+    data[agent_idx, frame_idx] = index['data'][np.ix_(agent_ids, frame_ids)][agent_idx, frame_idx]
+    present = np.zeros((len(agent_ids), len(frame_ids)), dtype=bool)
+    present[agent_idx, frame_idx] = True
+
+    filtered_index = dict(index)
+    filtered_index.update({
+        'data': data,
+        'present': present,
+        'agent_ids': index['agent_ids'][agent_ids],
+        'frame_ids': index['frame_ids'][frame_ids],
+        'agents': {agent: i for i, agent in enumerate(index['agent_ids'][agent_ids])},
+        'frames': {frame: i for i, frame in enumerate(index['frame_ids'][frame_ids])}
+    })
+    if 'sims' in index:
+        filtered_index['sims'] = index['sims'][frame_ids]
+    return filtered_index
 
 
 def get_scene_groups(agents, groups):
@@ -225,7 +245,22 @@ def get_scene_groups(agents, groups):
     return comb_groups_filtered
 
 
-def get_scene_data(dataframe, consecutive_frames, difference_between_frames, groups, step, sim=False):
+def get_window_agent_counts(present, starts, consecutive_frames):
+    """
+    Count in how many frames of each window every agent appears, using prefix sums over the presence bitmap,
+    so that moving the window costs the same regardless of its length.
+    :param present: boolean array of shape (agents, frames) showing if an agent appears in a frame
+    :param starts: array of frame indices where each window starts
+    :param consecutive_frames: number of frames in a window
+    :return: array of shape (windows, agents) with the number of frames each agent appears in each window
+    """
+    prefix = np.zeros((present.shape[0], present.shape[1] + 1), dtype=np.int32)
+    np.cumsum(present, axis=1, out=prefix[:, 1:])
+    return (prefix[:, starts + consecutive_frames] - prefix[:, starts]).T
+
+
+def get_scene_data(dataframe, consecutive_frames, difference_between_frames, groups, step, sim=False, index=None,
+                   all_windows=False):
     """
     Get scenes based on given parameters.
     :param dataframe: dataframe to be filtered
@@ -233,57 +268,89 @@ def get_scene_data(dataframe, consecutive_frames, difference_between_frames, gro
     :param difference_between_frames: difference between frames to be continuous
     :param groups: groups to check which groups exist in every scene
     :param step: difference between start of each time window
+    :param sim: True if groups are given per simulation, otherwise False
+    :param index: trajectory index of the dataframe, built from the dataframe if not given
+    :param all_windows: True to enumerate every window, including the one ending at the last frame, otherwise the
+    last window is skipped
     :return: scenes after filtering
     """
-    # get agents by frame
-    agents_by_frame = dataframe.groupby('frame_id')['agent_id'].apply(list).reset_index(name='agents')
-
-    # get frame combinations
-    frame_ids = agents_by_frame.frame_id.values
-    frame_id_combinations = [list(frame_ids[i:i + consecutive_frames]) for i in
-                             range(0, len(frame_ids[:-consecutive_frames]), step)]
-    frame_id_combinations = filter_difference_between_frame_combinations(frame_id_combinations,
-                                                                         difference_between_frames)
-
-    # check agents intersection in frame id combinations
+    if index is None:
+        index = get_trajectory_index(dataframe)
+    present = index['present']
+    agent_ids = index['agent_ids']
+
+    # get continuous frame windows
+    frame_ids = index['frame_ids']
+    last_start = len(frame_ids) - consecutive_frames + 1 if all_windows else len(frame_ids[:-consecutive_frames])
+    starts = np.arange(0, max(last_start, 0), step)
+    gaps = np.concatenate(([0], np.cumsum(np.diff(frame_ids) != difference_between_frames)))
+    starts = starts[gaps[starts + consecutive_frames - 1] == gaps[starts]]
+
+    # count frames of every agent in each window
+    counts = get_window_agent_counts(present, starts, consecutive_frames)
+    # ignore scenes with not enough common agents
+    valid = (counts == consecutive_frames).sum(axis=1) >= 2
+
+    if sim and 'sims' in index:
+        frame_sims = dict(zip(frame_ids, index['sims']))
+    elif sim:
+        frame_sims = dataframe.drop_duplicates('frame_id').set_index('frame_id')['sim']
+
+    # sets are built per frame and combined like before, so that agent order in scenes stays the same
+    frame_agents = {}
     scenes = []
-    for frames in frame_id_combinations:
-        agent_list = [set(agents_by_frame[agents_by_frame['frame_id'] == frame]['agents'].iloc[0]) for frame in frames]
+    for start in starts[valid]:
+        for frame_idx in range(start, start + consecutive_frames):
+            if frame_idx not in frame_agents:
+                frame_agents[frame_idx] = set(agent_ids[present[:, frame_idx]].tolist())
+        agent_list = [frame_agents[frame_idx] for frame_idx in range(start, start + consecutive_frames)]
+        frames = list(frame_ids[start:start + consecutive_frames])
         common_agents = set.intersection(*agent_list)
-        if sim:
-            scene_id = dataframe[dataframe['frame_id'] == frames[0]]['sim'].iloc[0]
-        # ignore scenes with not enough common agents
-        if len(common_agents) >= 2:
-            scene_dict = {
-                'frames': frames,
-                'common_agents': common_agents,
-                'total_agents': set.union(*agent_list),
-                'groups': groups[scene_id] if sim else get_scene_groups(common_agents, groups)
-            }
-            scenes.append(scene_dict)
+        scene_dict = {
+            'frames': frames,
+            'common_agents': common_agents,
+            'total_agents': set.union(*agent_list),
+            'groups': groups[frame_sims[frames[0]]] if sim else get_scene_groups(common_agents, groups)
+        }
+        scenes.append(scene_dict)
 
     return scenes
 
 
-def get_pairs_sample_rates(pairs, group_pairs, min_pair_samples, max_pair_samples):
+def get_step_scenes(scenes, index, step):
+    """
+    Select the scenes that get_scene_data would return for the given step, out of the scenes returned for step 1.
+    :param scenes: scenes enumerated with step 1
+    :param index: trajectory index of the dataset
+    :param step: difference between start of each time window
+    :return: scenes for the given step
+    """
+    return [scene for scene in scenes if index['frames'][scene['frames'][0]] % step == 0]
+
+
+def get_scene_group_ids(scene, group_ids=None, index=None):
+    """
+    Get group ids of the scene agents, ordered by agent id.
+    :param scene: scene dictionary
+    :param group_ids: group ids of every agent of the trajectory index, if not given they are built from scene groups
+    :param index: trajectory index of the dataset, needed if group_ids are given
+    :return: array of group ids
+    """
+    if group_ids is None:
+        return get_group_ids(scene['groups'], sorted(scene['common_agents']))
+    return group_ids[get_agent_indices(index, scene['common_agents'])]
+
+
+def get_pairs_sample_rates(same_group, min_pair_samples, max_pair_samples):
     """
     Set sample rate for pairs in same and different groups in order to have balanced samples.
-    :param pairs: list of pairs in scene
-    :param group_pairs: list of pairs in same group
+    :param same_group: boolean array showing for every pair in scene if its agents are in the same group
     :param min_pair_samples: minimum number of samples to get from a pair in a scene
     :param max_pair_samples: maximum number of samples to get from a pair in a scene
-    :return: list of pairs sample rates
+    :return: array of pairs sample rates
     """
-    same = []
-    different = []
-    for pair in pairs:
-        if pair in group_pairs:
-            same.append(pair)
-        else:
-            different.append(pair)
-
-    same_pairs_num = len(same)
-    different_pairs_num = len(different)
+    same_pairs_num = np.count_nonzero(same_group)
+    different_pairs_num = len(same_group) - same_pairs_num
 
     if same_pairs_num > different_pairs_num:
         same_pairs_sampling_rate = min_pair_samples
@@ -297,88 +364,115 @@ def get_pairs_sample_rates(pairs, group_pairs, min_pair_samples, max_pair_sample
         if same_pairs_num == 0:
             same_pairs_sampling_rate = 0
         else:
-            same_pairs_sampling_rate = min(
-                int(min_pair_samples * different_pairs_num / same_pairs_num) if same_pairs_num > 0 else 0,
-                max_pair_samples)
-
-    pairs_sample_rates = []
-    for pair in pairs:
-        if pair in same:
-            pairs_sample_rates.append(same_pairs_sampling_rate)
-        else:
-            pairs_sample_rates.append(different_pairs_sampling_rate)
+            same_pairs_sampling_rate = min(int(min_pair_samples * different_pairs_num / same_pairs_num),
+                                           max_pair_samples)
 
-    return pairs_sample_rates
+    return np.where(same_group, same_pairs_sampling_rate, different_pairs_sampling_rate)
 
 
-def dataset_size_calculator(group_pairs, scene_data, agents_minimum, min_pair_samples, max_pair_samples):
+def dataset_size_calculator(scene_data, agents_minimum, min_pair_samples, max_pair_samples, group_ids=None,
+                            index=None):
     """
     Gather data from all possible scenes based on given parameters.
-    :param group_pairs: pairs of agents in the same group
     :param scene_data: valid scenes
     :param agents_minimum: minimum agents (pair + context) in a scene
     :param min_pair_samples: minimum samples to get from a scene for each pair
     :param max_pair_samples: maximum samples to get from a scene for each pair
+    :param group_ids: group ids of every agent of the trajectory index, if not given they are built from scene groups
+    :param index: trajectory index of the dataset, needed if group_ids are given
     :return: dataset
     """
-    samples, same_pairs, different_pairs = 0, 0, 0
+    samples = 0
     for scene in scene_data:
-        scene_agents = scene['common_agents']
-
-        pairs = list(combinations(scene_agents, 2))
-        pairs_samples = get_pairs_sample_rates(pairs, group_pairs, min_pair_samples, max_pair_samples)
-        for pair_agents, pair_samples in zip(pairs, pairs_samples):
-            non_pair_agents = scene_agents - set(pair_agents)
-            if len(non_pair_agents) <= agents_minimum - 2:
-                samples += 1
-            else:
-                samples += pair_samples
+        scene_group_ids = get_scene_group_ids(scene, group_ids, index)
+        pairs_rows = np.array(list(combinations(range(len(scene_group_ids)), 2)), dtype=int).reshape(-1, 2)
+        # every pair has the rest of the scene agents as context
+        if len(scene_group_ids) - 2 <= agents_minimum - 2:
+            samples += len(pairs_rows)
+        else:
+            same_group = scene_group_ids[pairs_rows[:, 0]] == scene_group_ids[pairs_rows[:, 1]]
+            samples += get_pairs_sample_rates(same_group, min_pair_samples, max_pair_samples).sum()
     return samples
 
 
-def get_agent_data_for_frames(dataframe, agents, frames):
+def get_agent_indices(index, agents):
     """
-    Returns a list of tuples with location and velocity data for each frame and agent
-    :param dataframe: dataframe to retrieve data
-    :param agents: list of agents for who to retrieve data
-    :param frames: list of frames for which to retrieve data
-    :return: list of lists of data of each agent
+    Maps agent ids to rows of the trajectory index, sorted by agent id.
+    :param index: trajectory index of the dataset
+    :param agents: agent ids to be mapped
+    :return: array of agent indices
+    """
+    return np.sort(np.array([index['agents'][agent] for agent in agents], dtype=int))
+
+
+def get_frame_indices(index, frames):
+    """
+    Maps frame ids to columns of the trajectory index.
+    :param index: trajectory index of the dataset
+    :param frames: frame ids to be mapped
+    :return: array of frame indices
     """
-    data = dataframe[dataframe['frame_id'].isin(frames) & dataframe['agent_id'].isin(agents)]
-    return list(data.groupby('agent_id')['measurement'].apply(list).values)
+    return np.array([index['frames'][frame] for frame in frames], dtype=int)
+
+
+def get_scene_tensor(index, agents, frames):
+    """
+    Returns location and velocity data of the given agents for the given frames, ordered by agent id.
+    :param index: trajectory index of the dataset
+    :param agents: agent ids for who to retrieve data
+    :param frames: frame ids for which to retrieve data
+    :return: array of shape (agents, frames, features)
+    """
+    return index['data'][np.ix_(get_agent_indices(index, agents), get_frame_indices(index, frames))]
+
+
+def shift_scene_data(scene_data, pairs_idx):
+    """
+    Transforms the coordinates of every agent in the scene to the frame of reference of each pair. The origin is
+    the middle point of the pair and the x-axis points from the second to the first agent of the pair.
+    :param scene_data: array of shape (agents, frames, features) with location and velocity data of the scene
+    :param pairs_idx: array of shape (pairs, 2) with the indices of the pair agents in scene_data
+    :return: array of shape (pairs, agents, frames, features) with the transformed scene for every pair
+    """
+    pairs_idx = np.asarray(pairs_idx, dtype=int).reshape(-1, 2)
+    first = scene_data[pairs_idx[:, 0]]
+    second = scene_data[pairs_idx[:, 1]]
+    a = .5 * (first[:, :, 0] + second[:, :, 0])
+    b = .5 * (first[:, :, 1] + second[:, :, 1])
+    dx = first[:, :, 0] - second[:, :, 0]
+    dy = first[:, :, 1] - second[:, :, 1]
+    distance = np.sqrt(dx ** 2 + dy ** 2)
+
+    # a pair on the same location has no direction, so only the translation is applied
+    degenerate = distance == 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b0 = np.where(degenerate, 1., dx / distance)[:, np.newaxis]
+        b1 = np.where(degenerate, 0., dy / distance)[:, np.newaxis]
+
+    x_shift = scene_data[np.newaxis, :, :, 0] - a[:, np.newaxis]
+    y_shift = scene_data[np.newaxis, :, :, 1] - b[:, np.newaxis]
+
+    shifted_data = np.repeat(scene_data[np.newaxis], len(pairs_idx), axis=0)
+    shifted_data[:, :, :, 0] = b0 * x_shift + b1 * y_shift
+    shifted_data[:, :, :, 1] = b1 * x_shift - b0 * y_shift
+    return shifted_data
 
 
 def shift_data(pair_data, context_data, frames):
-    new_context_data = [[] for i in range(len(context_data))]
-    for i in range(frames):
-        x1 = pair_data[0][i][0]
-        y1 = pair_data[0][i][1]
-        x2 = pair_data[1][i][0]
-        y2 = pair_data[1][i][1]
-        a = .5 * (x1 + x2)
-        b = .5 * (y1 + y2)
-        dx = x1 - x2
-        dy = y1 - y2
-        b0 = dx / np.sqrt(dx ** 2 + dy ** 2)
-        b1 = dy / np.sqrt(dx ** 2 + dy ** 2)
-
-        for j, agent in enumerate(context_data):
-            x = agent[i][0]
-            y = agent[i][1]
-            # shift, project each x and y
-            x_shift = x - a
-            y_shift = y - b
-            x_proj = b0 * x_shift + b1 * y_shift
-            y_proj = b1 * x_shift - b0 * y_shift
-            new_context_data[j].append((x_proj, y_proj, agent[i][2], agent[i][3]))
-
-    return new_context_data
+    """
+    Transforms the context coordinates to the frame of reference of the pair.
+    :param pair_data: array of shape (2, frames, features) with data of the pair
+    :param context_data: array of shape (context, frames, features) with data of the context
+    :param frames: number of frames to transform
+    :return: array of shape (context, frames, features) with the transformed context
+    """
+    scene_data = np.concatenate((pair_data[:, :frames], context_data[:, :frames]))
+    return shift_scene_data(scene_data, [[0, 1]])[0, 2:]
 
 
 def fill_data(pair_data, context_data, fake_context):
-    for i in range(fake_context):
-        context_data.append([tuple([0] * len(pair_data[0][0]))] * len(pair_data[0]))
-    return context_data
+    fake_data = np.zeros((fake_context,) + pair_data.shape[1:], dtype=pair_data.dtype)
+    return np.concatenate((context_data, fake_data))
 
 
 def calculate_distance(x1, y1, x2, y2):
@@ -413,36 +507,43 @@ def context_sample(pair_data, non_pair_data, context_size):
     return context_data
 
 
-def get_pair_label(groups, agents):
-    """
-    Checks if agents are in the same group.
-    :param groups: list of groups to search
-    :param agents: tuple of agents to check
-    :return: True if agents are in the same, otherwise False
-    """
-    return any(all(agent in group for agent in agents) for group in groups)
+def gather_data(context_data, data, label, labels, pair_agents, pair_data, scene_frame_ids, scenes_frames):
+    data.append(np.concatenate((pair_data, context_data)))
+    labels.append(label)
+    scenes_frames.append((scene_frame_ids, pair_agents))
 
 
-def gather_data(context_data, data, groups, labels, pair_agents, pair_data, scene_frame_ids, scenes_frames):
-    data.append(pair_data + context_data)
-    labels.append(get_pair_label(groups, pair_agents))
-    scenes_frames.append((scene_frame_ids, pair_agents))
+def get_object_array(items):
+    """
+    Store (frames, agents) items in an object array of shape (items, 2), without letting numpy broadcast the items
+    further when all of them have the same length.
+    :param items: list of (frames, agents) tuples
+    :return: object array
+    """
+    array = np.empty((len(items), 2), dtype=object)
+    for i, (first, second) in enumerate(items):
+        array[i, 0] = first
+        array[i, 1] = second
+    return array
 
 
-def dataset_reformat(dataframe, groups, group_pairs, scene_data, agents_num, min_pair_samples,
-                     max_pair_samples, shift=False):
+def dataset_reformat(dataframe, scene_data, agents_num, min_pair_samples, max_pair_samples, shift=False, index=None,
+                     group_ids=None):
     """
     Gather data from all possible scenes based on given parameters.
     :param dataframe: dataframe to retrieve data
-    :param groups: list of groups
-    :param group_pairs: pairs of agents in the same group
     :param scene_data: valid continuous frame combinations
     :param agents_num: minimum agents (pair + context) in a scene
     :param min_pair_samples: minimum samples to get from a scene for each pair
     :param max_pair_samples: maximum samples to get from a scene for each pair
     :param shift: True if to transform context according to pair coordinates, otherwise False
+    :param index: trajectory index of the dataframe, built from the dataframe if not given
+    :param group_ids: group ids of every agent of the trajectory index, if not given they are built from scene groups
     :return: dataset
     """
+    if index is None:
+        index = get_trajectory_index(dataframe)
+
     data = []
     labels = []
     scenes_frames = []
@@ -450,111 +551,130 @@ def dataset_reformat(dataframe, groups, group_pairs, scene_data, agents_num, min
     for scene in scene_data:
         scene_frame_ids = scene['frames']
         scene_groups = scene['groups']
-        scene_agents = scene['common_agents']
+        # pairs are taken in agent id order, so that they do not depend on the iteration order of the set
+        scene_agents = sorted(scene['common_agents'])
+        scene_tensor = get_scene_tensor(index, scene_agents, scene_frame_ids)
 
         pairs = list(combinations(scene_agents, 2))
-        pairs_samples = get_pairs_sample_rates(pairs, group_pairs, min_pair_samples, max_pair_samples)
-        for pair_agents, pair_samples in zip(pairs, pairs_samples):
-            non_pair_agents = scene_agents - set(pair_agents)
-            pair_data = get_agent_data_for_frames(dataframe, pair_agents, scene_frame_ids)
-            non_pair_data = get_agent_data_for_frames(dataframe, non_pair_agents, scene_frame_ids)
-            if shift and len(non_pair_data) > 0:
-                non_pair_data = shift_data(pair_data, non_pair_data, len(scene_frame_ids))
+        pairs_rows = np.array(list(combinations(range(len(scene_agents)), 2)), dtype=int).reshape(-1, 2)
+        scene_group_ids = get_scene_group_ids(scene, group_ids, index)
+        pairs_labels = scene_group_ids[pairs_rows[:, 0]] == scene_group_ids[pairs_rows[:, 1]]
+        pairs_samples = get_pairs_sample_rates(pairs_labels, min_pair_samples, max_pair_samples)
+        if shift and len(scene_agents) > 2:
+            # transform the scene to the coordinates of every pair at once
+            pairs_scenes = shift_scene_data(scene_tensor, pairs_rows)
+        else:
+            pairs_scenes = np.broadcast_to(scene_tensor, (len(pairs),) + scene_tensor.shape)
+        for pair_scene, pair_rows, pair_agents, pair_label, pair_samples in \
+                zip(pairs_scenes, pairs_rows, pairs, pairs_labels, pairs_samples):
+            pair_data = scene_tensor[pair_rows]
+            non_pair_data = np.delete(pair_scene, pair_rows, axis=0)
             if len(non_pair_data) <= agents_num - 2:
-                context_data = non_pair_data[:]
                 fake_context = agents_num - 2 - len(non_pair_data)
-                context_data = fill_data(pair_data, context_data, fake_context)
-                gather_data(context_data, data, groups, labels, pair_agents, pair_data, scene_frame_ids, scenes_frames)
+                context_data = fill_data(pair_data, non_pair_data, fake_context)
+                gather_data(context_data, data, pair_label, labels, pair_agents, pair_data, scene_frame_ids,
+                            scenes_frames)
             else:
                 for i in range(pair_samples):
                     # random sampling
-                    context_data = random.sample(non_pair_data, agents_num - 2)
+                    context_data = non_pair_data[random.sample(range(len(non_pair_data)), agents_num - 2)]
                     # getting the closest agents
                     # context_data = context_sample(pair_data, non_pair_data, agents_minimum - 2)
                     gather_data(
-                        context_data, data, groups, labels, pair_agents, pair_data, scene_frame_ids, scenes_frames)
+                        context_data, data, pair_label, labels, pair_agents, pair_data, scene_frame_ids, scenes_frames)
         scenes_groups.append((scene_frame_ids, scene_groups))
-    return np.asarray(data), np.asarray(labels), np.asarray(scenes_frames, dtype=object), np.asarray(scenes_groups,
-                                                                                                     dtype=object)
+    return np.asarray(data), np.asarray(labels), get_object_array(scenes_frames), get_object_array(scenes_groups)
 
 
-def folds_split(frames, folds_num, multi_frame=False):
+def get_scene_keys(frames):
+    """
+    Encode the scene of every sample as an integer key. Scenes of a dataset have the same number of frames, so a scene
+    is identified by its first frame.
+    :param frames: array with the frames of the scene of every sample in the first column, or array of the frame ids
+    of the scene of every sample
+    :return: array of scene keys
+    """
+    if frames.dtype != object:
+        return frames[:, 0].astype(np.int64)
+    return np.array([frame_ids[0] for frame_ids in frames[:, 0]], dtype=np.int64).reshape(len(frames))
+
+
+def get_scene_values(frames, keys, multi_frame=False):
+    """
+    Get the keys of the distinct scenes, in the order in which scenes are split. Multi frame scenes keep the order of
+    the set of frame tuples in which they were originally split.
+    :param frames: array with the frames of the scene of every sample in the first column, or array of the frame ids
+    of the scene of every sample
+    :param keys: scene key of every sample
+    :param multi_frame: True if scenes include multiple frames, otherwise False
+    :return: array of scene keys
+    """
+    if not multi_frame:
+        return np.unique(keys)
+    scene_frames = frames[:, 0] if frames.dtype == object else frames
+    first_idx = np.sort(np.unique(keys, return_index=True)[1])
+    scene_keys = {tuple(scene_frames[i]): keys[i] for i in first_idx}
+    return np.array([scene_keys[scene] for scene in set(tuple(scene_frames[i]) for i in first_idx)], dtype=np.int64)
+
+
+def folds_split(frames, folds_num, multi_frame=False, keys=None):
     """
     Split frames based on frame id and split in folds.
     :param frames: list of frames
     :param folds_num: number of folds to split frames
     :param multi_frame: True if scenes include multiple frames, otherwise False
-    :return:
+    :param keys: scene key of every sample, computed from frames if not given
+    :return: train and test indices of every fold
     """
-    frame_ids = [frame[0] for frame in frames]
-    if multi_frame:
-        frame_values = [list(x) for x in set(tuple(frame_id) for frame_id in frame_ids)]
-    else:
-        frame_values = np.unique(frame_ids)
-
+    if keys is None:
+        keys = get_scene_keys(frames)
+    frame_values = get_scene_values(frames, keys, multi_frame)
     fold_size = len(frame_values) // folds_num
-
     folds_idx = []
     for i in range(folds_num):
         start_idx = i * fold_size
         end_idx = (i + 1) * fold_size
-
         if i == folds_num - 1:
             test_fold_frame_values = frame_values[start_idx:]
         else:
             test_fold_frame_values = frame_values[start_idx:end_idx]
-        test_fold_idx = [i for i, frame in enumerate(frame_ids) if frame in test_fold_frame_values]
-        train_fold_idx = [i for i, frame in enumerate(frame_ids) if frame not in test_fold_frame_values]
-        folds_idx.append((train_fold_idx, test_fold_idx))
-
+        test_fold = np.isin(keys, test_fold_frame_values)
+        folds_idx.append((np.flatnonzero(~test_fold), np.flatnonzero(test_fold)))
     return folds_idx
 
 
-def train_val_split_frames(frames, idx, multi_frame=False):
+def train_val_split_frames(frames, idx, multi_frame=False, keys=None):
     """
     Split train, test and val indices.
     :param frames: list of frames
     :param idx: list of indices corresponding to the train and val set
     :param multi_frame: True if scenes include multiple frames, otherwise False
+    :param keys: scene key of every sample, computed from frames if not given
     :return: train and val indices
     """
-    frame_ids = [frame[0] for frame in frames]
-    train_val_frame_ids = [frame[0] for frame in frames[idx]]
-    if multi_frame:
-        frame_values = [list(x) for x in set(tuple(frame_id) for frame_id in train_val_frame_ids)]
-    else:
-        frame_values = np.unique(train_val_frame_ids)
+    if keys is None:
+        keys = get_scene_keys(frames)
+    frame_values = get_scene_values(frames[idx], keys[idx], multi_frame)
     train, val = train_test_split(frame_values, test_size=0.3, random_state=0)
-    idx_train = [i for i, frame in enumerate(frame_ids) if frame in train]
-    idx_val = [i for i, frame in enumerate(frame_ids) if frame in val]
+    idx_train = np.flatnonzero(np.isin(keys, train))
+    idx_val = np.flatnonzero(np.isin(keys, val))
     return idx_train, idx_val
 
 
 def train_test_split_groups(groups, frames_train, frames_test, frames_val, multi_frame=False):
     """
     Split groups in train, test and val groups.
-    :param groups: list of groups per frame
+    :param groups: array of groups per scene
     :param frames_train: list of train frames
     :param frames_test: list of test frames
     :param frames_val: list of val frames
     :param multi_frame: True if scenes include multiple frames, otherwise False
-    :return: groups split in train, test and val sets
-    """
-    if multi_frame:
-        frame_ids_train = [frame[0] for frame in frames_train]
-        frame_ids_train = [list(x) for x in set(tuple(frame_id) for frame_id in frame_ids_train)]
-        frame_ids_test = [frame[0] for frame in frames_test]
-        frame_ids_test = [list(x) for x in set(tuple(frame_id) for frame_id in frame_ids_test)]
-        frame_ids_val = [frame[0] for frame in frames_val]
-        frame_ids_val = [list(x) for x in set(tuple(frame_id) for frame_id in frame_ids_val)]
-    else:
-
-        frame_ids_train = np.unique([frame[0] for frame in frames_train])
-        frame_ids_test = np.unique([frame[0] for frame in frames_test])
-        frame_ids_val = np.unique([frame[0] for frame in frames_val])
-    groups_train = [group for group in groups if group[0] in frame_ids_train]
-    groups_test = [group for group in groups if group[0] in frame_ids_test]
-    groups_val = [group for group in groups if group[0] in frame_ids_val]
+    :return: indices of the groups of the train, test and val sets
+    """
+    group_keys = get_scene_keys(groups)
+    groups_train = np.flatnonzero(np.isin(group_keys, get_scene_keys(frames_train)))
+    groups_test = np.flatnonzero(np.isin(group_keys, get_scene_keys(frames_test)))
+    groups_val = np.flatnonzero(np.isin(group_keys, get_scene_keys(frames_val)))
     return groups_train, groups_test, groups_val
 
 
@@ -563,32 +683,80 @@ def dump(path, data):
         pickle.dump(data, f)
 
 
-def save_folds(save_folder, dataset, frames_num, agents_num, data, labels, frames, groups, multi_frame, folds_num=5,
-               features=4):
-    if not multi_frame:
-        data = data.reshape((len(data), 1, agents_num, features))
+def save_samples(path, data, labels, frames, groups, frames_num):
+    """
+    Save the samples of a dataset as .npy files, which can be opened memory mapped: the data as a float32 block of
+    shape (samples, agents, frames, features), the labels, the frames and pair of every sample as integer arrays and
+    the groups of every scene as frames, number of groups, group sizes and the agents of all groups concatenated.
+    :param path: samples folder
+    :param data: data of the dataset
+    :param labels: labels of the dataset
+    :param frames: frames and pair of every sample
+    :param groups: frames and groups of every scene
+    :param frames_num: number of frames in a scene
+    :return: nothing
+    """
+    scene_groups = [scene[1] for scene in groups]
+    group_sizes = [len(group) for scene in scene_groups for group in scene]
+    group_agents = [agent for scene in scene_groups for group in scene for agent in group]
+    arrays = {
+        'data': np.ascontiguousarray(data, dtype=np.float32),
+        'labels': np.asarray(labels),
+        'frames': np.array(list(frames[:, 0]), dtype=np.int64).reshape((len(frames), frames_num)),
+        'pairs': np.array(list(frames[:, 1]), dtype=np.int64).reshape((len(frames), 2)),
+        'group_frames': np.array([scene[0] for scene in groups], dtype=np.int64).reshape((len(groups), frames_num)),
+        'groups_num': np.array([len(scene) for scene in scene_groups], dtype=np.int64),
+        'group_sizes': np.array(group_sizes, dtype=np.int64),
+        'group_agents': np.array(group_agents, dtype=np.int64)
+    }
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save('{}/{}.npy'.format(path, name), array)
 
-    for i, (idx_train_val, idx_test) in enumerate(folds_split(frames, folds_num, multi_frame)):
-        idx_train, idx_val = train_val_split_frames(frames, idx_train_val, multi_frame)
+
+def save_fold_indices(path, frames, groups, multi_frame, folds_num=5):
+    """
+    Split the samples of a dataset in folds and save the indices of the samples and the groups of the train, test and
+    val sets of every fold.
+    :param path: folder of the dataset
+    :param frames: frames and pair of every sample, or frame ids of every sample
+    :param groups: frames and groups of every scene, or frame ids of every scene
+    :param multi_frame: True if scenes include multiple frames, otherwise False
+    :param folds_num: number of folds
+    :return: nothing
+    """
+    keys = get_scene_keys(frames)
+    for i, (idx_train_val, idx_test) in enumerate(folds_split(frames, folds_num, multi_frame, keys)):
+        idx_train, idx_val = train_val_split_frames(frames, idx_train_val, multi_frame, keys)
         groups_train, groups_test, groups_val = \
             train_test_split_groups(groups, frames[idx_train], frames[idx_test], frames[idx_val], multi_frame)
+        fold_path = '{}/fold_{}'.format(path, i)
+        os.makedirs(fold_path, exist_ok=True)
+        for split, idx, groups_idx in [('train', idx_train, groups_train), ('test', idx_test, groups_test),
+                                       ('val', idx_val, groups_val)]:
+            np.save('{}/{}_samples.npy'.format(fold_path, split), np.asarray(idx, dtype=np.int64))
+            np.save('{}/{}_groups.npy'.format(fold_path, split), np.asarray(groups_idx, dtype=np.int64))
 
-        if multi_frame:
-            train = (
-                [data[idx_train, j, :] for j in range(agents_num)], labels[idx_train], frames[idx_train], groups_train)
-            test = ([data[idx_test, j, :] for j in range(agents_num)], labels[idx_test], frames[idx_test], groups_test)
-            val = ([data[idx_val, j, :] for j in range(agents_num)], labels[idx_val], frames[idx_val], groups_val)
-        else:
-            train = (
-                [data[idx_train, :, 2:], data[idx_train, :, :2]], labels[idx_train], frames[idx_train], groups_train)
-            test = ([data[idx_test, :, 2:], data[idx_test, :, :2]], labels[idx_test], frames[idx_test], groups_test)
-            val = ([data[idx_val, :, 2:], data[idx_val, :, :2]], labels[idx_val], frames[idx_val], groups_val)
 
-        path = '{}/{}_{}_{}/fold_{}'.format(save_folder, dataset, frames_num, agents_num, i)
-        os.makedirs(path, exist_ok=True)
-        dump('{}/train.p'.format(path), train)
-        dump('{}/test.p'.format(path), test)
-        dump('{}/val.p'.format(path), val)
+def save_folds(save_folder, dataset, frames_num, agents_num, data, labels, frames, groups, multi_frame, folds_num=5):
+    """
+    Save the samples of a dataset once with save_samples and split them in folds. Every fold only stores the indices
+    of the samples and the groups of its train, test and val sets.
+    :param save_folder: folder to save the folds
+    :param dataset: name of the dataset
+    :param frames_num: number of frames in a scene
+    :param agents_num: number of agents in a sample
+    :param data: data of the dataset, of shape (samples, agents, frames, features)
+    :param labels: labels of the dataset
+    :param frames: frames and pair of every sample
+    :param groups: frames and groups of every scene
+    :param multi_frame: True if scenes include multiple frames, otherwise False
+    :param folds_num: number of folds
+    :return: nothing
+    """
+    path = '{}/{}_{}_{}'.format(save_folder, dataset, frames_num, agents_num)
+    save_samples('{}/samples'.format(path), data, labels, frames, groups, frames_num)
+    save_fold_indices(path, frames, groups, multi_frame, folds_num)
 
 
 def get_labels(agents, pairs):
@@ -597,7 +765,10 @@ def get_labels(agents, pairs):
     return labels
 
 
-def get_no_context_data(dataframe, scene_data):
+def get_no_context_data(dataframe, scene_data, index=None):
+    if index is None:
+        index = get_trajectory_index(dataframe)
+
     data = []
     labels = []
     scenes_frames = []
@@ -607,39 +778,31 @@ def get_no_context_data(dataframe, scene_data):
         group_pairs = get_no_context_group_pairs(scene_groups)
         scene_agents = scene['common_agents']
 
-        agent_data = get_agent_data_for_frames(dataframe, scene_agents, scene_frame_ids)
-        data.append(np.asarray(agent_data)[:, :, :2])
+        agent_data = get_scene_tensor(index, scene_agents, scene_frame_ids)
+        data.append(agent_data[:, :, :2])
         labels.append(np.asarray(get_labels(scene_agents, group_pairs)))
         scenes_frames.append(scene_frame_ids)
 
     return np.asarray(data, dtype=object), np.asarray(labels, dtype=object), scenes_frames
 
 
-def load_pickle_file(file):
-    with open(file, 'rb') as f:
-        return pickle.load(f)
-
-
 def get_folds_info(save_folder, dataset, frames_num, agents_num):
     info = []
     path = '{}/{}_{}_{}'.format(save_folder, dataset, frames_num, agents_num)
-
-    for fold in os.listdir(path):
+    frames = np.load('{}/samples/frames.npy'.format(path))
+    for fold in [fold for fold in os.listdir(path) if fold.startswith('fold_')]:
         fold_path = '{}/{}'.format(path, fold)
-        train = load_pickle_file('{}/train.p'.format(fold_path))
-        test = load_pickle_file('{}/test.p'.format(fold_path))
-        val = load_pickle_file('{}/val.p'.format(fold_path))
-
-        info.append((list(train[2][:, 0]), list(test[2][:, 0]), list(val[2][:, 0])))
-
+        splits_idx = [np.load('{}/{}_samples.npy'.format(fold_path, split)) for split in ['train', 'test', 'val']]
+        info.append(tuple(frames[idx, 0] for idx in splits_idx))
     return info
 
 
 def save_no_context_folds(save_folder, dataset, frames_num, data, labels, frames, folds_info):
+    keys = np.array([frame_ids[0] for frame_ids in frames], dtype=np.int64)
     for i, (frame_ids_train, frame_ids_test, frame_ids_val) in enumerate(folds_info):
-        idx_train = [i for i, frame_id in enumerate(frames) if frame_id in frame_ids_train]
-        idx_test = [i for i, frame_id in enumerate(frames) if frame_id in frame_ids_test]
-        idx_val = [i for i, frame_id in enumerate(frames) if frame_id in frame_ids_val]
+        idx_train = np.flatnonzero(np.isin(keys, frame_ids_train))
+        idx_test = np.flatnonzero(np.isin(keys, frame_ids_test))
+        idx_val = np.flatnonzero(np.isin(keys, frame_ids_val))
         train = ([torch.tensor(i) for i in data[idx_train]], [torch.tensor(i) for i in labels[idx_train]])
         test = ([torch.tensor(i) for i in data[idx_test]], [torch.tensor(i) for i in labels[idx_test]])
         val = ([torch.tensor(i) for i in data[idx_val]], [torch.tensor(i) for i in labels[idx_val]])
@@ -654,6 +817,59 @@ def save_no_context_folds(save_folder, dataset, frames_num, data, labels, frames
         dump('{}/labels_valid.pkl'.format(path), val[1])
 
 
+# trajectory index and group ids of every dataset, shared with the pool workers
+worker_datasets = {}
+
+
+def init_worker(datasets):
+    """
+    Share trajectory indices and group ids of the datasets with a pool worker.
+    :param datasets: dictionary of (index, group_ids) tuples for every dataset
+    :return: nothing
+    """
+    worker_datasets.update(datasets)
+
+
+def get_chunk_tasks(dataset, scenes, seed, chunk_size, params):
+    """
+    Split the scenes of a dataset in chunks to be reformatted independently.
+    :param dataset: name of the dataset
+    :param scenes: scenes of the dataset
+    :param seed: global seed
+    :param chunk_size: number of scenes in a chunk
+    :param params: dataset_reformat keyword arguments
+    :return: list of tasks
+    """
+    return [(dataset, scenes[start:start + chunk_size], get_seed(seed, dataset, chunk), params)
+            for chunk, start in enumerate(range(0, max(len(scenes), 1), chunk_size))]
+
+
+def reformat_chunk(task):
+    """
+    Reformat a chunk of scenes of a dataset, after seeding the random generators with the seed of the chunk.
+    :param task: tuple of dataset name, scenes, seed and dataset_reformat keyword arguments
+    :return: reformatted chunk
+    """
+    dataset, scenes, seed, params = task
+    random.seed(seed)
+    np.random.seed(seed)
+    index, group_ids = worker_datasets[dataset]
+    return dataset_reformat(dataframe=None, scene_data=scenes, index=index, group_ids=group_ids, **params)
+
+
+def merge_chunks(chunks):
+    """
+    Concatenate reformatted chunks of a dataset, keeping the order of the chunks.
+    :param chunks: list of dataset_reformat results
+    :return: data, labels, frames and groups of the dataset
+    """
+    merged = []
+    for i in range(4):
+        arrays = [chunk[i] for chunk in chunks if len(chunk[i]) > 0]
+        merged.append(np.concatenate(arrays) if len(arrays) > 0 else chunks[0][i])
+    return tuple(merged)
+
+
 def get_sample_params(frames_num, agents_num):
     if frames_num == 1:
         multi_frame = False
@@ -796,6 +1012,98 @@ def get_sample_params(frames_num, agents_num):
     return multi_frame, min_samples, max_samples, steps
 
 
+def get_sweep_configs(configs):
+    """
+    Parse (frames_num, agents_num) configurations given as strings in the form framesxagents.
+    :param configs: list of configuration strings, all configurations of get_sample_params if empty
+    :return: list of (frames_num, agents_num) tuples
+    """
+    if len(configs) == 0:
+        return [(frames_num, agents_num) for frames_num in [1, 5, 10] for agents_num in [6, 10]]
+    return [tuple(int(value) for value in config.split('x')) for config in configs]
+
+
+def prepare_configs(datasets_dict, configs, save_folder, seed, shift, chunk_size, workers=1, filter_data=False):
+    """
+    Reformat every dataset for every (frames_num, agents_num) configuration and save it in folds. Each dataset is
+    indexed once and its scenes are enumerated once for every window length.
+    :param datasets_dict: dictionary with data of every dataset
+    :param configs: list of (frames_num, agents_num) tuples
+    :param save_folder: folder to save the folds
+    :param seed: global seed
+    :param shift: True if to transform context according to pair coordinates, otherwise False
+    :param chunk_size: number of scenes in a chunk
+    :param workers: number of processes to reformat the chunks
+    :param filter_data: True if to remove agents and frames with insufficient data for every configuration
+    :return: list of (frames_num, agents_num, samples, duration) tuples for every configuration
+    """
+    # filtered data depend on the configuration, so they are indexed once for every configuration
+    config_datasets = {}
+    for frames_num, agents_num in configs:
+        for dataset, dataset_dict in datasets_dict.items():
+            key = '{}_{}_{}'.format(dataset, frames_num, agents_num) if filter_data else dataset
+            config_datasets[(frames_num, agents_num, dataset)] = key
+            if key in worker_datasets:
+                continue
+            index = dataset_dict['index']
+            if filter_data:
+                index = remove_index_agents_and_frames_with_insufficient_data(
+                    index=index, agents_threshold=agents_num, frames_threshold=frames_num)
+            worker_datasets[key] = (index, get_group_ids(dataset_dict['groups'], index['agent_ids']))
+
+    # scenes of every window length, enumerated with step 1
+    window_scenes = {}
+    for (frames_num, agents_num, dataset), key in config_datasets.items():
+        if (key, frames_num) not in window_scenes:
+            window_scenes[(key, frames_num)] = \
+                get_scene_data(dataframe=None, consecutive_frames=frames_num,
+                               difference_between_frames=datasets_dict[dataset]['difference'],
+                               groups=datasets_dict[dataset]['groups'], step=1, index=worker_datasets[key][0])
+
+    pool = Pool(workers, initializer=init_worker, initargs=(worker_datasets,)) if workers > 1 else None
+    timings = []
+    for frames_num, agents_num in configs:
+        config_start = datetime.now()
+        multi_frame, min_samples, max_samples, steps = get_sample_params(frames_num, agents_num)
+
+        tasks = []
+        for dataset in datasets_dict.keys():
+            key = config_datasets[(frames_num, agents_num, dataset)]
+            scenes = get_step_scenes(window_scenes[(key, frames_num)], worker_datasets[key][0], steps[dataset])
+            params = {
+                'agents_num': agents_num,
+                'min_pair_samples': min_samples[dataset],
+                'max_pair_samples': max_samples[dataset],
+                'shift': shift
+            }
+            tasks.extend(get_chunk_tasks(key, scenes, seed, chunk_size, params))
+
+        if pool is None:
+            results = [reformat_chunk(task) for task in tasks]
+        else:
+            results = pool.map(reformat_chunk, tasks, chunksize=1)
+
+        samples = 0
+        for dataset in datasets_dict.keys():
+            key = config_datasets[(frames_num, agents_num, dataset)]
+            data, labels, frames, filtered_groups = \
+                merge_chunks([result for task, result in zip(tasks, results) if task[0] == key])
+            samples += len(data)
+
+            dataset_name = '{}_shifted'.format(dataset) if shift else dataset
+            # save dataset in folds
+            save_folds(save_folder, dataset_name, frames_num, agents_num, data, labels, frames, filtered_groups,
+                       multi_frame)
+            print('Frames: {}, agents: {}, dataset: {}, data size: {}'.format(
+                frames_num, agents_num, dataset_name, len(data)))
+
+        timings.append((frames_num, agents_num, samples, datetime.now() - config_start))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return timings
+
+
 def get_args():
     parser = argparse.ArgumentParser()
 
@@ -809,6 +1117,12 @@ def get_args():
     parser.add_argument('-s', '--shift', action="store_true", default=True)
     parser.add_argument('-r', '--report', action="store_true", default=False)
     parser.add_argument('-c', '--context', action="store_true", default=False)
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument('-cs', '--chunk_size', type=int, default=50)
+    parser.add_argument('-fi', '--filter', action="store_true", default=False,
+                        help='remove agents with less frames and frames with less agents than the configuration')
+    parser.add_argument('-sw', '--sweep', type=str, nargs='*', default=None,
+                        help='framesxagents configurations to prepare, e.g. 5x6 10x10, all if no value is given')
 
     return parser.parse_args()
 
@@ -844,39 +1158,41 @@ if __name__ == '__main__':
     if args.plot:
         groups_size_hist(groups_dict, './group_size_plot.png')
 
-    multi_frame, min_samples, max_samples, steps = get_sample_params(args.frames_num, args.agents_num)
-    for dataset in datasets_dict.keys():
-        dataset_start = datetime.now()
-        print('Dataset: {}, started at: {}'.format(dataset, dataset_start))
-
-        df = datasets_dict[dataset]['df']
-        groups = datasets_dict[dataset]['groups']
-        group_pairs = get_group_pairs(groups)
-        difference = datasets_dict[dataset]['difference']
-
-        # remove frames with low number of frames or agents
-        # df = remove_agents_and_frames_with_insufficient_data(dataframe=df, frames_threshold=args.frames_num,
-        #                                                      agents_threshold=args.agents_num)
-
-        # get scene data
-        scenes = get_scene_data(dataframe=df, consecutive_frames=args.frames_num, difference_between_frames=difference,
-                                groups=groups, step=steps[dataset])
-
-        if args.context:
-            # format dataset to be used by proposed approach
-            data, labels, frames, filtered_groups = dataset_reformat(dataframe=df, groups=groups,
-                                                                     group_pairs=group_pairs,
-                                                                     scene_data=scenes, agents_num=args.agents_num,
-                                                                     min_pair_samples=min_samples[dataset],
-                                                                     max_pair_samples=max_samples[dataset],
-                                                                     shift=args.shift)
-
-            dataset = '{}_shifted'.format(dataset) if args.shift else dataset
-            # save dataset in folds
-            save_folds(args.save_folder, dataset, args.frames_num, args.agents_num, data, labels, frames,
-                       filtered_groups, multi_frame)
+    if args.context:
+        # format datasets to be used by proposed approach
+        if args.sweep is None:
+            configs = [(args.frames_num, args.agents_num)]
         else:
-            no_context_data, no_context_labels, no_context_frames = get_no_context_data(dataframe=df, scene_data=scenes)
+            configs = get_sweep_configs(args.sweep)
+
+        timings = prepare_configs(datasets_dict, configs, args.save_folder, args.seed, args.shift, args.chunk_size,
+                                  args.workers, args.filter)
+
+        print('{:<10s} {:<10s} {:<10s} {:<10s}'.format('frames', 'agents', 'samples', 'duration'))
+        for frames_num, agents_num, samples, duration in timings:
+            print('{:<10d} {:<10d} {:<10d} {}'.format(frames_num, agents_num, samples, duration))
+    else:
+        multi_frame, min_samples, max_samples, steps = get_sample_params(args.frames_num, args.agents_num)
+        for dataset in datasets_dict.keys():
+            dataset_start = datetime.now()
+            print('Dataset: {}, started at: {}'.format(dataset, dataset_start))
+
+            index = datasets_dict[dataset]['index']
+            groups = datasets_dict[dataset]['groups']
+            difference = datasets_dict[dataset]['difference']
+
+            # remove frames with low number of frames or agents
+            if args.filter:
+                index = remove_index_agents_and_frames_with_insufficient_data(
+                    index=index, frames_threshold=args.frames_num, agents_threshold=args.agents_num)
+
+            # get scene data
+            scenes = get_scene_data(dataframe=None, consecutive_frames=args.frames_num,
+                                    difference_between_frames=difference, groups=groups, step=steps[dataset],
+                                    index=index)
+
+            no_context_data, no_context_labels, no_context_frames = get_no_context_data(dataframe=None,
+                                                                                        scene_data=scenes, index=index)
             dataset = '{}_shifted'.format(dataset) if args.shift else dataset
             folds_info = get_folds_info(args.save_folder, dataset, args.frames_num, args.agents_num)
             save_no_context_folds(args.save_folder, dataset, args.frames_num, no_context_data, no_context_labels,
@@ -884,10 +1200,8 @@ if __name__ == '__main__':
             # data_tensor = torch.from_numpy(no_context_data)
             # labels_tensor = torch.from_numpy(no_context_data)
 
-        end = datetime.now()
-        print('Dataset: {}, finished in: {}'.format(dataset, end - dataset_start))
-        # print('\tdata size: {}'.format(len(data)))
-        dataset_start = end
+            end = datetime.now()
+            print('Dataset: {}, finished in: {}'.format(dataset, end - dataset_start))
 
     end = datetime.now()
     print('Finished in: {}'.format(end - start))
@@ -1,11 +1,16 @@
 import argparse
+import json
 import os
+import shutil
 import time
+from multiprocessing import Pool
 
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
+from datasets.loader import get_seed, merge_shards
+
 
 def groups_initialize(n, ga_values_factor, n_groups):
     """
@@ -32,6 +37,32 @@ def groups_initialize(n, ga_values_factor, n_groups):
     return group_initial, ga_dict, ga_matrix, ga_values, gr_matrix
 
 
+def get_interaction_probabilities(groups, k=3, b=0.1):
+    """
+    Get the probability of every interaction based on equation P(I[i,j]=1|G[i,j])=1-exp(-k(G[i,j]+b)).
+    :param groups: G of the equation
+    :param k: controls the overall magnitude of the probabilities
+    :param b: has great impact on the non-group interaction probability
+    :return: interaction probabilities
+    """
+    p_interaction = 1 - np.exp(-k * (groups + b))
+    p_no_interaction = np.exp(-k * (groups + b))
+    # normalized like np.random.choice does, so that the same interactions are sampled
+    return p_interaction / (p_interaction + p_no_interaction)
+
+
+def sample_interactions(probabilities):
+    """
+    Sample symmetric interactions without self interactions.
+    :param probabilities: interaction probabilities, of shape [..., n, n]
+    :return: interactions
+    """
+    I = (np.random.random_sample(probabilities.shape) < probabilities).astype(float)
+    # Symmetric
+    I = np.tril(I, -1)
+    return I + np.swapaxes(I, -1, -2)
+
+
 def groups_to_interactions(groups, k=3, b=0.1):
     """
     Convert groups to interactions based on equation P(I[i,j]=1|G[i,j])=1-exp(-k(G[i,j]+b)).
@@ -40,14 +71,7 @@ def groups_to_interactions(groups, k=3, b=0.1):
     :param b: has great impact on the non-group interaction probability
     :return: interactions
     """
-    I = np.zeros_like(groups)
-    for i in range(groups.shape[0]):
-        for j in range(groups.shape[1]):
-            I[i, j] = np.random.choice([1, 0], p=[1 - np.exp(-k * (groups[i, j] + b)), np.exp(-k * (groups[i, j] + b))])
-    np.fill_diagonal(I, 0)
-    # Symmetric
-    I = np.tril(I) + np.tril(I).T
-    return I
+    return sample_interactions(get_interaction_probabilities(groups, k, b))
 
 
 class SpringSim(object):
@@ -56,7 +80,7 @@ class SpringSim(object):
     """
 
     def __init__(self, n_balls=5, box_size=10., loc_std=0.5, vel_norm=0.5, interaction_strength=0.1, noise_var=0.,
-                 ga_values_factor=3, K=3, b=0.001, n_groups=2):
+                 ga_values_factor=3, K=3, b=0.001, n_groups=2, integrator='leapfrog', tolerance=1e-6):
         self.n_balls = n_balls
         self.box_size = box_size
         self.loc_std = loc_std
@@ -70,20 +94,32 @@ class SpringSim(object):
         self.K = K
         self.b = b
         self.n_groups = n_groups
+        # 'leapfrog' with interactions sampled at every step, or 'rk4' with adaptive steps and interactions
+        # sampled once per sample interval, a different model whose data are not comparable to leapfrog data
+        self.integrator = integrator
+        self.tolerance = tolerance
+        self.force_evaluations = 0
+        self.rk4_steps = 0
+        self._step_size = None
+
+    def trajectory_energy(self, loc, vel, edges):
+        """
+        Compute the kinetic and potential energy of all time steps of a trajectory at once.
+        :param loc: [..., 2, N] locations, e.g. Tx2xN for a trajectory
+        :param vel: [..., 2, N] velocities
+        :param edges: [..., N, N] interaction edges of every time step, or NxN edges of all time steps
+        :return: kinetic and potential energy, of shape [...]
+        """
+        kinetic = 0.5 * (vel ** 2).sum(axis=(-2, -1))
+        r = loc[..., :, :, np.newaxis] - loc[..., :, np.newaxis, :]
+        dist_squared = (r ** 2).sum(axis=-3)
+        off_diagonal = ~np.eye(loc.shape[-1], dtype=bool)
+        potential = (0.5 * self.interaction_strength * edges * dist_squared / 2 * off_diagonal).sum(axis=(-2, -1))
+        return kinetic, potential
 
     def _energy(self, loc, vel, edges):
-        # disables division by zero warning, since I fix it with fill_diagonal
-        with np.errstate(divide="ignore"):
-            K = 0.5 * (vel ** 2).sum()  # kinetic energy
-            U = 0  # potential energy
-            for i in range(loc.shape[1]):
-                for j in range(loc.shape[1]):
-                    if i != j:
-                        r = loc[:, i] - loc[:, j]
-                        dist = np.sqrt((r ** 2).sum())
-                        U += 0.5 * self.interaction_strength * edges[
-                            i, j] * (dist ** 2) / 2
-            return U + K
+        kinetic, potential = self.trajectory_energy(loc, vel, edges)
+        return potential + kinetic
 
     def _clamp(self, loc, vel):
         """
@@ -120,100 +156,378 @@ class SpringSim(object):
         dist = A_norm + B_norm - 2 * A.dot(B.transpose())
         return dist
 
-    def sample_trajectory(self, T=10000, sample_freq=100):
+    def _forces(self, loc, edges):
+        """
+        :param loc: Bx2xN locations at one time step
+        :param edges: BxNxN interaction edges
+        :return: Bx2xN forces, clipped to max_F
+        """
+        n = loc.shape[-1]
+        forces_size = -self.interaction_strength * edges
+        forces_size[..., np.arange(n), np.arange(n)] = 0  # self forces are zero
+        F = (forces_size[:, np.newaxis] * (loc[:, :, :, np.newaxis] - loc[:, :, np.newaxis, :])).sum(axis=-1)
+        F[F > self._max_F] = self._max_F
+        F[F < -self._max_F] = -self._max_F
+        return F
+
+    def _initialize(self, batch_size):
+        """
+        Initialize groups, interaction probabilities, interactions, locations and velocities of a batch.
+        :param batch_size: number of simulations B
+        :return: group assignments, group relationships, interaction probabilities, interactions,
+        Bx2xN locations and Bx2xN velocities
+        """
+        n = self.n_balls
+
+        # Initialize groups and interaction probabilities
+        ga = np.zeros((batch_size, n), dtype=int)
+        gr = np.zeros((batch_size, n, n))
+        probabilities = np.zeros((batch_size, n, n))
+        edges = np.zeros((batch_size, n, n))
+        for sim in range(batch_size):
+            ga[sim], _, _, _, gr[sim] = groups_initialize(n, self.ga_values_factor, self.n_groups)
+            probabilities[sim] = get_interaction_probabilities(gr[sim], self.K, self.b)
+            # Initialize Interaction matrix
+            edges[sim] = sample_interactions(probabilities[sim])
+
+        # Initialize location and velocity
+        loc_next = np.random.randn(batch_size, 2, n) * self.loc_std
+        vel_next = np.random.randn(batch_size, 2, n)
+        v_norm = np.sqrt((vel_next ** 2).sum(axis=1)).reshape(batch_size, 1, n)
+        vel_next = vel_next * self.vel_norm / v_norm
+        return ga, gr, probabilities, edges, loc_next, vel_next
+
+    def _leapfrog(self, loc, vel, edges, steps):
+        """
+        Integrate with leapfrog steps of _delta_T and constant interactions.
+        :param loc: Bx2xN locations
+        :param vel: Bx2xN velocities
+        :param edges: BxNxN interaction edges
+        :param steps: number of steps
+        :return: locations, velocities and number of force evaluations
+        """
+        for _ in range(steps):
+            vel += self._delta_T * self._forces(loc, edges)
+            loc += self._delta_T * vel
+            loc, vel = self._clamp(loc, vel)
+        return loc, vel, steps
+
+    def _fixed_rk4(self, loc, vel, edges, steps):
+        """
+        Integrate with Runge-Kutta steps of _delta_T and constant interactions, as a reference of the other
+        integrators.
+        :param loc: Bx2xN locations
+        :param vel: Bx2xN velocities
+        :param edges: BxNxN interaction edges
+        :param steps: number of steps
+        :return: locations, velocities and number of force evaluations
+        """
+        for _ in range(steps):
+            loc, vel = self._rk4_step(loc, vel, edges, self._delta_T)
+        return loc, vel, 4 * steps
+
+    def _rk4_step(self, loc, vel, edges, h):
+        """
+        :param loc: Bx2xN locations
+        :param vel: Bx2xN velocities
+        :param edges: BxNxN interaction edges
+        :param h: step size
+        :return: locations and velocities after a classic Runge-Kutta step of size h
+        """
+        a1 = self._forces(loc, edges)
+        v2 = vel + h / 2 * a1
+        a2 = self._forces(loc + h / 2 * vel, edges)
+        v3 = vel + h / 2 * a2
+        a3 = self._forces(loc + h / 2 * v2, edges)
+        v4 = vel + h * a3
+        a4 = self._forces(loc + h * v3, edges)
+        loc = loc + h / 6 * (vel + 2 * v2 + 2 * v3 + v4)
+        vel = vel + h / 6 * (a1 + 2 * a2 + 2 * a3 + a4)
+        return self._clamp(loc, vel)
+
+    def _adaptive_rk4(self, loc, vel, edges, steps):
+        """
+        Integrate the time of the given number of leapfrog steps with Runge-Kutta steps of adaptive size and
+        constant interactions. The local error of every step is estimated with step doubling and kept under
+        tolerance, so the error of a trajectory is bounded by the number of accepted steps (rk4_steps) times tolerance.
+        :param loc: Bx2xN locations
+        :param vel: Bx2xN velocities
+        :param edges: BxNxN interaction edges
+        :param steps: number of leapfrog steps of _delta_T to cover
+        :return: locations, velocities and number of force evaluations
+        """
+        t, end = 0., steps * self._delta_T
+        h = end if self._step_size is None else self._step_size
+        evaluations = 0
+        while end - t > 1e-9 * end:
+            h = min(h, end - t)
+            full_loc, full_vel = self._rk4_step(loc, vel, edges, h)
+            half_loc, half_vel = self._rk4_step(loc, vel, edges, h / 2)
+            half_loc, half_vel = self._rk4_step(half_loc, half_vel, edges, h / 2)
+            evaluations += 12
+            error = max(np.abs(half_loc - full_loc).max(), np.abs(half_vel - full_vel).max()) / 15
+            if error <= self.tolerance:
+                loc, vel = half_loc, half_vel
+                t += h
+                self.rk4_steps += 1
+            # grow or shrink the step for the 5th order error of step doubling
+            h *= min(2., max(0.2, 0.9 * (self.tolerance / max(error, 1e-300)) ** 0.2))
+        self._step_size = h
+        return loc, vel, evaluations
+
+    def _sample_intervals(self, batch_size, T, sample_freq, integrate, resample=True):
+        """
+        Sample a batch of simulations with interactions that are sampled once per sample interval, integrating
+        every interval with the given integrator.
+        :param batch_size: number of simulations B
+        :param T: length of the simulations
+        :param sample_freq: sample frequency of the simulations
+        :param integrate: integrator of a sample interval, _leapfrog, _adaptive_rk4 or _fixed_rk4
+        :param resample: False to keep the initial interactions for the whole simulations
+        :return: locations [B, T_save, 2, n], velocities [B, T_save, 2, n], interactions [B, T_save, n, n] of the
+        interval ending at every sample, group assignments [B, n] and group relationships [B, n, n]
         """
-        Interaction edges may change at each timestep
-        if dynamic, the group assignment will be re-evaluated at each sampled
-            timestep according to ga_values
-            ga_values will change at each time according to current group assignment ga_matrix
-            and group assignment ages ga_ages
-            if the group assignment ga_matrix[i] changes at one sampled timestep,
-            the corresponding ga_ages[i] will be reset to 0 and the ga_values[i] will be reset
-            to ga_values_factor*ga_matrix[i]
+        n = self.n_balls
+        assert (T % sample_freq == 0)
+        T_save = int(T / sample_freq - 1)
+        self.force_evaluations = 0
+        self.rk4_steps = 0
+        self._step_size = None
+
+        ga, gr, probabilities, edges, loc_next, vel_next = self._initialize(batch_size)
+        loc_next, vel_next = self._clamp(loc_next, vel_next)
+        loc = np.zeros((batch_size, T_save, 2, n))
+        vel = np.zeros((batch_size, T_save, 2, n))
+        inter = np.zeros((batch_size, T_save, n, n))
+
+        for counter in range(T_save):
+            loc_next, vel_next, evaluations = integrate(loc_next, vel_next, edges, sample_freq)
+            self.force_evaluations += evaluations
+            loc[:, counter, :, :], vel[:, counter, :, :] = loc_next, vel_next
+            inter[:, counter, :, :] = edges
+            if resample:
+                edges = sample_interactions(probabilities)
+
+        # Add noise to observations
+        loc += np.random.randn(batch_size, T_save, 2, n) * self.noise_var
+        vel += np.random.randn(batch_size, T_save, 2, n) * self.noise_var
+        return loc, vel, inter, ga, gr
+
+    def sample_trajectories(self, batch_size=1, T=10000, sample_freq=100):
+        """
+        Sample a batch of simulations at once, with [B, 2, n] location and velocity states.
+        Interaction edges are sampled at each timestep from interaction probabilities computed once per simulation,
+        or once per sample interval with the rk4 integrator.
+        :param batch_size: number of simulations B
+        :param T: length of the simulations
+        :param sample_freq: sample frequency of the simulations
+        :return: locations [B, T_save, 2, n], velocities [B, T_save, 2, n], interactions [B, T_save, n, n],
+        group assignments [B, n] and group relationships [B, n, n]
         """
+        if self.integrator == 'rk4':
+            return self._sample_intervals(batch_size, T, sample_freq, self._adaptive_rk4)
+
         n = self.n_balls
-        K = self.K
-        b = self.b
-        n_groups = self.n_groups
-        ga_values_factor = self.ga_values_factor
         assert (T % sample_freq == 0)
         T_save = int(T / sample_freq - 1)
         counter = 0
 
-        # Initialize groups
-        ga, ga_dict, ga_matrix, ga_values, gr = groups_initialize(n, ga_values_factor, n_groups)
-        # Initialize Interaction matrix
-        edges = groups_to_interactions(gr, K, b)
+        ga, gr, probabilities, edges, loc_next, vel_next = self._initialize(batch_size)
+        loc = np.zeros((batch_size, T_save, 2, n))
+        vel = np.zeros((batch_size, T_save, 2, n))
+        loc[:, 0, :, :], vel[:, 0, :, :] = self._clamp(loc_next, vel_next)
+        inter = np.zeros((batch_size, T_save, n, n))
+        inter[:, 0, :, :] = edges
 
-        # Initialize location and velocity
-        loc = np.zeros((T_save, 2, n))
-        vel = np.zeros((T_save, 2, n))
-        loc_next = np.random.randn(2, n) * self.loc_std
-        vel_next = np.random.randn(2, n)
-        v_norm = np.sqrt((vel_next ** 2).sum(axis=0)).reshape(1, -1)
-        vel_next = vel_next * self.vel_norm / v_norm
-        loc[0, :, :], vel[0, :, :] = self._clamp(loc_next, vel_next)
-        inter = np.zeros((T_save, n, n))
-        inter[0, :, :] = edges
-
-        # disables division by zero warning, since I fix it with fill_diagonal
-        with np.errstate(divide="ignore"):
-            forces_size = - self.interaction_strength * edges
-            np.fill_diagonal(forces_size, 0)  # self forces are zero (fixes division by zero)
-            F = (forces_size.reshape(1, n, n) *
-                 np.concatenate((
-                     np.subtract.outer(loc_next[0, :],
-                                       loc_next[0, :]).reshape(1, n, n),
-                     np.subtract.outer(loc_next[1, :],
-                                       loc_next[1, :]).reshape(1, n, n)))).sum(
-                axis=-1)
-            F[F > self._max_F] = self._max_F
-            F[F < -self._max_F] = -self._max_F
-
-            vel_next += self._delta_T * F
-
-            # run leapfrog
-            for i in range(1, T):
-                # Assumption: the next states(loc and vel) are determined by
-                # current states and current interaction edges
-                loc_next += self._delta_T * vel_next
-                loc_next, vel_next = self._clamp(loc_next, vel_next)
-                # compute current interaction edges based on group relationship
-                edges = groups_to_interactions(gr, K, b)
-
-                if i % sample_freq == 0:
-                    loc[counter, :, :], vel[counter, :, :] = loc_next, vel_next
-                    inter[counter, :, :] = edges
-                    counter += 1
-
-                forces_size = -self.interaction_strength * edges
-                np.fill_diagonal(forces_size, 0)
-
-                F = (forces_size.reshape(1, n, n) *
-                     np.concatenate((
-                         np.subtract.outer(loc_next[0, :],
-                                           loc_next[0, :]).reshape(1, n, n),
-                         np.subtract.outer(loc_next[1, :],
-                                           loc_next[1, :]).reshape(1, n, n)))).sum(
-                    axis=-1)
-
-                F[F > self._max_F] = self._max_F
-                F[F < -self._max_F] = -self._max_F
-                vel_next += self._delta_T * F
-
-            # Add noise to observations
-            loc += np.random.randn(T_save, 2, n) * self.noise_var
-            vel += np.random.randn(T_save, 2, n) * self.noise_var
-            return loc, vel, inter, ga, gr
-
-
-def generate_dataset(simulation, num_sims, length, sample_freq):
+        vel_next += self._delta_T * self._forces(loc_next, edges)
+
+        # run leapfrog
+        for i in range(1, T):
+            # Assumption: the next states(loc and vel) are determined by
+            # current states and current interaction edges
+            loc_next += self._delta_T * vel_next
+            loc_next, vel_next = self._clamp(loc_next, vel_next)
+            # sample current interaction edges based on group relationship
+            edges = sample_interactions(probabilities)
+
+            if i % sample_freq == 0:
+                loc[:, counter, :, :], vel[:, counter, :, :] = loc_next, vel_next
+                inter[:, counter, :, :] = edges
+                counter += 1
+
+            vel_next += self._delta_T * self._forces(loc_next, edges)
+
+        # Add noise to observations
+        loc += np.random.randn(batch_size, T_save, 2, n) * self.noise_var
+        vel += np.random.randn(batch_size, T_save, 2, n) * self.noise_var
+        return loc, vel, inter, ga, gr
+
+    def sample_trajectory(self, T=10000, sample_freq=100):
+        """
+        Sample one simulation, see sample_trajectories.
+        :param T: length of the simulation
+        :param sample_freq: sample frequency of the simulation
+        :return: locations, velocities, interactions, group assignments and group relationships of the simulation
+        """
+        loc, vel, inter, ga, gr = self.sample_trajectories(1, T, sample_freq)
+        return loc[0], vel[0], inter[0], ga[0], gr[0]
+
+
+def get_wall_free_simulations(simulation, loc, vel, sample_freq):
+    """
+    Find the simulations that stay away from the walls, also between their samples. Walls reflect at the end of
+    integration steps, which adds an error of the order of the step that tolerances do not control.
+    :param simulation: SpringSim object
+    :param loc: [B, T_save, 2, n] locations
+    :param vel: [B, T_save, 2, n] velocities
+    :param sample_freq: sample frequency of the simulations
+    :return: [B] mask of the simulations that never reach a wall
+    """
+    reach = 2 * np.abs(vel).max(axis=(1, 2, 3)) * sample_freq * simulation._delta_T
+    return np.abs(loc).max(axis=(1, 2, 3)) + reach < simulation.box_size
+
+
+def get_deviation(loc, vel, reference_loc, reference_vel, simulations):
+    """
+    Get the max deviation of locations and velocities from a reference, over the given simulations.
+    :param loc: [B, T_save, 2, n] locations
+    :param vel: [B, T_save, 2, n] velocities
+    :param reference_loc: [B, T_save, 2, n] reference locations
+    :param reference_vel: [B, T_save, 2, n] reference velocities
+    :param simulations: [B] mask of the simulations
+    :return: max deviation
+    """
+    if not simulations.any():
+        return 0.
+    return max(np.abs(loc - reference_loc)[simulations].max(), np.abs(vel - reference_vel)[simulations].max())
+
+
+def benchmark_integrators(simulation, batch_size, length, sample_freq, seed):
+    """
+    Compare the leapfrog and the adaptive rk4 integrators with a reference of Runge-Kutta steps of _delta_T, on the
+    same initial states and interactions sampled once per sample interval. This is the model of the rk4 mode, the
+    default leapfrog mode samples interactions at every step, so its trajectories are not comparable.
+    Deviations are measured on the simulations that do not reach a wall.
+    :param simulation: SpringSim object
+    :param batch_size: number of simulations to sample at once
+    :param length: length of simulation
+    :param sample_freq: sample frequency of simulation
+    :param seed: random seed of all integrators
+    :return: dictionary with the time, force evaluations and max deviation from the reference of every integrator,
+    and the error bound of rk4
+    """
+    results = {}
+    for name, integrate in [('reference', simulation._fixed_rk4), ('leapfrog', simulation._leapfrog),
+                            ('rk4', simulation._adaptive_rk4)]:
+        np.random.seed(seed)
+        t = time.time()
+        loc, vel, _, _, _ = simulation._sample_intervals(batch_size, length, sample_freq, integrate)
+        results[name] = {'time': time.time() - t, 'force_evaluations': simulation.force_evaluations,
+                         'loc': loc, 'vel': vel}
+    results['rk4']['error_bound'] = simulation.rk4_steps * simulation.tolerance
+
+    reference = results['reference']
+    results['wall_free'] = get_wall_free_simulations(simulation, reference['loc'], reference['vel'], sample_freq)
+    print('simulations without wall reflections: {}/{}'.format(results['wall_free'].sum(), batch_size))
+    for name in ['leapfrog', 'rk4']:
+        results[name]['deviation'] = get_deviation(results[name]['loc'], results[name]['vel'], reference['loc'],
+                                                   reference['vel'], results['wall_free'])
+        print('{}: time: {:.3f}s, force evaluations: {}, max deviation from reference: {:.3g}'.format(
+            name, results[name]['time'], results[name]['force_evaluations'], results[name]['deviation']))
+    print('rk4 speedup: {:.2f}, error bound: {:.3g}'.format(
+        results['leapfrog']['time'] / results['rk4']['time'], results['rk4']['error_bound']))
+    return results
+
+
+def check_integrator_error(simulation, batch_size, length, sample_freq, seed, tolerances=(1e-5, 1e-6, 1e-7, 1e-8)):
+    """
+    Check that the deviation of the rk4 integrator from the reference of benchmark_integrators stays under its error
+    bound for every tolerance, and is smaller for the smallest tolerance than for the largest one if it took more
+    steps, on the simulations that do not reach a wall.
+    :param simulation: SpringSim object
+    :param batch_size: number of simulations to sample at once
+    :param length: length of simulation
+    :param sample_freq: sample frequency of simulation
+    :param seed: random seed of all integrators
+    :param tolerances: tolerances to check, in decreasing order
+    :return: list of (tolerance, deviation, error bound) tuples
+    """
+    np.random.seed(seed)
+    reference_loc, reference_vel, _, _, _ = simulation._sample_intervals(batch_size, length, sample_freq,
+                                                                         simulation._fixed_rk4)
+    wall_free = get_wall_free_simulations(simulation, reference_loc, reference_vel, sample_freq)
+    if not wall_free.any():
+        raise ValueError('every simulation reaches a wall, use shorter simulations')
+    print('simulations without wall reflections: {}/{}'.format(wall_free.sum(), batch_size))
+
+    tolerance = simulation.tolerance
+    errors = []
+    steps = []
+    for simulation.tolerance in tolerances:
+        np.random.seed(seed)
+        loc, vel, _, _, _ = simulation._sample_intervals(batch_size, length, sample_freq, simulation._adaptive_rk4)
+        deviation = get_deviation(loc, vel, reference_loc, reference_vel, wall_free)
+        errors.append((simulation.tolerance, deviation, simulation.rk4_steps * simulation.tolerance))
+        steps.append(simulation.rk4_steps)
+        print('tolerance: {:.0e}, max deviation: {:.3g}, error bound: {:.3g}'.format(*errors[-1]))
+    simulation.tolerance = tolerance
+
+    for tolerance, deviation, error_bound in errors:
+        if deviation > error_bound:
+            raise ValueError('deviation {:.3g} of tolerance {:.0e} is over its error bound {:.3g}'.format(
+                deviation, tolerance, error_bound))
+    # steps limited by the sample interval instead of the tolerance do not get more accurate
+    if steps[-1] > steps[0] and errors[-1][1] >= errors[0][1]:
+        raise ValueError('deviation does not decrease from tolerance {:.0e} to {:.0e}'.format(
+            errors[0][0], errors[-1][0]))
+    return errors
+
+
+def get_energy_drift(energies):
+    """
+    Get statistics of the energy drift of trajectories, relative to their initial energy.
+    :param energies: [..., T] energies of trajectories
+    :return: dictionary with the mean and max absolute relative drift and the mean relative drift at the end
+    """
+    drift = (energies - energies[..., :1]) / np.abs(energies[..., :1])
+    return {
+        'mean': np.abs(drift).mean(),
+        'max': np.abs(drift).max(),
+        'final': drift[..., -1].mean()
+    }
+
+
+def check_energy_drift(simulation, batch_size, length, sample_freq, seed):
+    """
+    Compare the energy drift of the integrators on simulations whose interactions are fixed for their whole length,
+    so that the drift comes from the integration steps instead of interactions switching on and off.
+    :param simulation: SpringSim object
+    :param batch_size: number of simulations to sample at once
+    :param length: length of simulation
+    :param sample_freq: sample frequency of simulation
+    :param seed: random seed of all integrators
+    :return: dictionary with the energy drift of every integrator, see get_energy_drift
+    """
+    drifts = {}
+    for name, integrate in [('leapfrog', simulation._leapfrog), ('rk4', simulation._adaptive_rk4)]:
+        np.random.seed(seed)
+        loc, vel, inter, _, _ = simulation._sample_intervals(batch_size, length, sample_freq, integrate,
+                                                             resample=False)
+        kinetic, potential = simulation.trajectory_energy(loc, vel, inter)
+        drifts[name] = get_energy_drift(kinetic + potential)
+        print('{}: energy drift mean: {:.4g}, max: {:.4g}, final: {:.4g}'.format(
+            name, drifts[name]['mean'], drifts[name]['max'], drifts[name]['final']))
+    return drifts
+
+
+def generate_dataset(simulation, num_sims, length, sample_freq, batch_size=1):
     """
     Generate dataset of simulations.
     :param simulation: SpringSim object
     :param num_sims: number of simulations to generate
     :param length: length of simulation
     :param sample_freq: sample frequency of simulation
+    :param batch_size: number of simulations to sample at once
     :return:
     """
     locations = list()  # shape: [num_sims, num_sampledTimesteps, num_features, num_atoms]
@@ -224,11 +538,12 @@ def generate_dataset(simulation, num_sims, length, sample_freq):
     # group relationship list
     group_relationships = list()  # shape: [num_sims, (num_sampledTimesteps), num_atoms, num_atoms]
 
-    for i in range(num_sims):
+    for i in range(0, num_sims, batch_size):
         t = time.time()
-        # return vectors of one simulation
-        loc, vel, inter, ga, gr = simulation.sample_trajectory(T=length, sample_freq=sample_freq)
-        if i % 100 == 0:
+        # return vectors of a batch of simulations
+        loc, vel, inter, ga, gr = simulation.sample_trajectories(min(batch_size, num_sims - i), T=length,
+                                                                 sample_freq=sample_freq)
+        if i % 100 < batch_size:
             print("Iter: {}, Simulation time: {}".format(i, time.time() - t))
 
         locations.append(loc)
@@ -237,15 +552,94 @@ def generate_dataset(simulation, num_sims, length, sample_freq):
         group_assignments.append(ga)
         group_relationships.append(gr)
 
-    locations = np.stack(locations)
-    velocities = np.stack(velocities)
-    interactions = np.stack(interactions)
-    group_assignments = np.stack(group_assignments)
-    group_relationships = np.stack(group_relationships)
+    locations = np.concatenate(locations)
+    velocities = np.concatenate(velocities)
+    interactions = np.concatenate(interactions)
+    group_assignments = np.concatenate(group_assignments)
+    group_relationships = np.concatenate(group_relationships)
 
     return locations, velocities, interactions, group_assignments, group_relationships
 
 
+SIM_KEYS = ['loc', 'vel', 'inter', 'ga', 'gr']
+
+
+def generate_shard(task):
+    """
+    Generate the simulations of a shard and save them, unless the shard is already saved.
+    The shard is written to a temporary folder first, so that an interrupted run never leaves a partial shard.
+    :param task: tuple of simulation, shard path, shard number, number of simulations, length, sample frequency,
+    batch size, global seed and suffix of the dataset files
+    :return: shard path
+    """
+    simulation, shard_path, shard, num_sims, length, sample_freq, batch_size, seed, suffix = task
+    if os.path.exists(shard_path):
+        return shard_path
+    np.random.seed(get_seed(seed, shard))
+    arrays = generate_dataset(simulation, num_sims, length, sample_freq, batch_size)
+    tmp_path = '{}.tmp'.format(shard_path)
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for key, array in zip(SIM_KEYS, arrays):
+        np.save('{}/{}_sim_{}.npy'.format(tmp_path, key, suffix), array)
+    os.replace(tmp_path, shard_path)
+    return shard_path
+
+
+def generate_sharded_dataset(simulation, path, suffix, num_sims, length, sample_freq, batch_size, seed, shard_size,
+                             workers=1):
+    """
+    Generate dataset of simulations in shards of shard_size simulations, on a pool of workers.
+    Every shard is saved as soon as it is generated, and shards found on disk are reused, so that an interrupted
+    run can be resumed. The shards are merged into the files of the dataset at the end.
+    :param simulation: SpringSim object
+    :param path: folder of the dataset
+    :param suffix: suffix of the dataset files
+    :param num_sims: number of simulations to generate
+    :param length: length of simulation
+    :param sample_freq: sample frequency of simulation
+    :param batch_size: number of simulations to sample at once
+    :param seed: global seed
+    :param shard_size: number of simulations of each shard
+    :param workers: number of worker processes
+    :return: nothing
+    """
+    shards_path = '{}/shards_{}'.format(path, suffix)
+    os.makedirs(shards_path, exist_ok=True)
+
+    # shards can only be reused if they were generated with the same parameters
+    params = {'num_sims': num_sims, 'length': length, 'sample_freq': sample_freq, 'batch_size': batch_size,
+              'seed': seed, 'shard_size': shard_size, 'simulation': vars(simulation)}
+    params_path = '{}/params.json'.format(shards_path)
+    if os.path.exists(params_path):
+        with open(params_path) as file:
+            if json.load(file) != params:
+                raise ValueError('shards in {} were generated with different parameters'.format(shards_path))
+    else:
+        with open(params_path, 'w') as file:
+            json.dump(params, file)
+
+    tasks = []
+    for shard, start in enumerate(range(0, num_sims, shard_size)):
+        shard_path = '{}/shard_{:05d}'.format(shards_path, shard)
+        tasks.append((simulation, shard_path, shard, min(shard_size, num_sims - start), length, sample_freq,
+                      batch_size, seed, suffix))
+    print('Shards: {}, already generated: {}'.format(len(tasks), sum(os.path.exists(task[1]) for task in tasks)))
+
+    if workers > 1:
+        with Pool(workers) as pool:
+            for i, shard_path in enumerate(pool.imap_unordered(generate_shard, tasks)):
+                print('Generated {}/{} shards'.format(i + 1, len(tasks)))
+    else:
+        for i, task in enumerate(tasks):
+            generate_shard(task)
+            print('Generated {}/{} shards'.format(i + 1, len(tasks)))
+
+    merge_shards(path, [task[1] for task in tasks])
+    shutil.rmtree(shards_path)
+
+
 def get_simulation_dataframe(locations, velocities):
     """
     Get dataframe of simulation.
@@ -253,20 +647,13 @@ def get_simulation_dataframe(locations, velocities):
     :param velocities: velocity data
     :return: dataframe of simulation
     """
+    sims, frames, _, agents = locations.shape
     data = np.concatenate((locations.transpose(0, 3, 1, 2), velocities.transpose(0, 3, 1, 2)), axis=3)
 
-    agent_dfs = []
-
-    for sim in range(data.shape[0]):
-        sim_data = data[sim]
-        for agent in range(sim_data.shape[0]):
-            agent_df = pd.DataFrame(sim_data[agent].reshape(-1, 4), columns=['pos_x', 'pos_y', 'v_x', 'v_y'])
-            agent_df['agent_id'] = agent
-            agent_df['frame_id'] = [i for i, _ in enumerate(agent_df['agent_id'])]
-            agent_df['sim'] = sim
-            agent_dfs.append(agent_df)
-
-    df = pd.concat(agent_dfs, ignore_index=True)
+    df = pd.DataFrame(data.reshape(-1, 4), columns=['pos_x', 'pos_y', 'v_x', 'v_y'])
+    df['agent_id'] = np.tile(np.repeat(np.arange(agents), frames), sims)
+    df['frame_id'] = np.tile(np.arange(frames), sims * agents)
+    df['sim'] = np.repeat(np.arange(sims), agents * frames)
 
     return df
 
@@ -288,11 +675,13 @@ def get_group_list(ga):
     return group_list
 
 
-def save_data(save_folder, df, groups, name, data):
+def save_data(save_folder, df, groups, name, data=None):
     save_folder_path = save_folder + '/sim_{}'.format(name)
 
     os.makedirs(save_folder_path, exist_ok=True)
-    df.to_csv('{}/data.csv'.format(save_folder_path), index=False)
+    if df is not None:
+        # the loader reads the loc and vel arrays, the csv is only needed by other tools
+        df.to_csv('{}/data.csv'.format(save_folder_path), index=False)
 
     group_filename = '{}/groups.txt'.format(save_folder_path)
 
@@ -304,6 +693,9 @@ def save_data(save_folder, df, groups, name, data):
                 file.write(' '.join(str(agent_id) for agent_id in group) + '\n')
             file.write('-\n')
 
+    if data is None:
+        # arrays already saved, e.g. merged from shards
+        return
     np.save('{}/loc_sim_{}.npy'.format(save_folder_path, suffix), data['loc'])
     np.save('{}/vel_sim_{}.npy'.format(save_folder_path, suffix), data['vel'])
     np.save('{}/inter_sim_{}.npy'.format(save_folder_path, suffix), data['inter'])
@@ -331,8 +723,8 @@ def plot(sim, loc, vel, inter, ga):
         plt.plot(loc[0, 0, i], loc[0, 1, i], color=colors[ga[i]], marker='o')
 
     plt.figure()
-    energies = [sim._energy(loc[i, :, :], vel[i, :, :], inter) for i in range(loc.shape[0])]
-    plt.plot(energies)
+    kinetic, potential = sim.trajectory_energy(loc, vel, inter)
+    plt.plot(kinetic + potential)
     plt.title('Energies')
     plt.show()
 
@@ -343,6 +735,21 @@ def get_args():
     parser.add_argument("--num-sim", type=int, default=1, help="number of simulations to perform.")
     parser.add_argument("--length", type=int, default=5000, help="length of trajectory.")
     parser.add_argument("--sample-freq", type=int, default=100, help="how often to sample the trajectory.")
+    parser.add_argument("--batch-size", type=int, default=1, help="number of simulations to sample at once.")
+    parser.add_argument("--shard-size", type=int, default=0,
+                        help="number of simulations of each shard, sharded generation is resumable (0 to disable).")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes of sharded generation.")
+    parser.add_argument("--integrator", type=str, default='leapfrog', choices=['leapfrog', 'rk4'],
+                        help="leapfrog, or adaptive rk4 with interactions sampled once per sample interval, "
+                             "which is a different model than the default datasets.")
+    parser.add_argument("--tolerance", type=float, default=1e-6,
+                        help="local error tolerance of every step of the rk4 integrator.")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="benchmark leapfrog and rk4 against a fine rk4 reference and exit.")
+    parser.add_argument("--check-integrator", action="store_true",
+                        help="check the rk4 deviation from the reference against its error bound and exit.")
+    parser.add_argument("--check-drift", action="store_true",
+                        help="compare the energy drift of the integrators with fixed interactions and exit.")
     parser.add_argument("--n-balls", type=int, default=10, help="number of balls in the simulation.")
     parser.add_argument("--ga-values-factor", type=int, default=5, help="group assignment value factor")
     parser.add_argument("--K", type=float, default=3.0, help="K")
@@ -351,6 +758,7 @@ def get_args():
     parser.add_argument('--groups', type=int, default=3)
     parser.add_argument('--save_folder', type=str, default='.')
     parser.add_argument('--plot', action="store_true", default=True)
+    parser.add_argument('--csv', action="store_true", help="also save the simulations as a data.csv file.")
 
     return parser.parse_args()
 
@@ -360,29 +768,53 @@ if __name__ == '__main__':
     print(args)
 
     simulation = SpringSim(n_balls=args.n_balls, ga_values_factor=args.ga_values_factor, K=args.K, b=args.b,
-                           n_groups=args.groups)
+                           n_groups=args.groups, integrator=args.integrator, tolerance=args.tolerance)
+
+    if args.benchmark:
+        benchmark_integrators(simulation, args.batch_size, args.length, args.sample_freq, args.seed)
+        exit()
+    if args.check_integrator:
+        check_integrator_error(simulation, args.batch_size, args.length, args.sample_freq, args.seed)
+        exit()
+    if args.check_drift:
+        check_energy_drift(simulation, args.batch_size, args.length, args.sample_freq, args.seed)
+        exit()
 
     np.random.seed(args.seed)
+    suffix = '{}_{}_{}'.format(args.n_balls, int(args.K), int(args.b * 100))
 
     print("Generating {} simulations".format(args.num_sim))
-    locations, velocities, interactions, group_assignments, group_relationships = generate_dataset(
-        simulation,
-        args.num_sim,
-        args.length,
-        args.sample_freq)
-
-    df = get_simulation_dataframe(locations, velocities)
-    groups = get_group_list(group_assignments)
-
-    data = {
-        'loc': locations,
-        'vel': velocities,
-        'inter': interactions,
-        'ga': group_assignments,
-        'gr': group_relationships
-    }
-    suffix = '{}_{}_{}'.format(args.n_balls, int(args.K), int(args.b * 100))
-    save_data(args.save_folder, df, groups, suffix, data)
+    if args.shard_size > 0:
+        save_folder_path = args.save_folder + '/sim_{}'.format(suffix)
+        os.makedirs(save_folder_path, exist_ok=True)
+        generate_sharded_dataset(simulation, save_folder_path, suffix, args.num_sim, args.length, args.sample_freq,
+                                 args.batch_size, args.seed, args.shard_size, args.workers)
+        data = {key: np.load('{}/{}_sim_{}.npy'.format(save_folder_path, key, suffix), mmap_mode='r')
+                for key in SIM_KEYS}
+        locations, velocities, interactions, group_assignments, group_relationships = \
+            [data[key] for key in SIM_KEYS]
+        df = get_simulation_dataframe(locations, velocities) if args.csv else None
+        groups = get_group_list(group_assignments)
+        save_data(args.save_folder, df, groups, suffix)
+    else:
+        locations, velocities, interactions, group_assignments, group_relationships = generate_dataset(
+            simulation,
+            args.num_sim,
+            args.length,
+            args.sample_freq,
+            args.batch_size)
+
+        df = get_simulation_dataframe(locations, velocities) if args.csv else None
+        groups = get_group_list(group_assignments)
+
+        data = {
+            'loc': locations,
+            'vel': velocities,
+            'inter': interactions,
+            'ga': group_assignments,
+            'gr': group_relationships
+        }
+        save_data(args.save_folder, df, groups, suffix, data)
 
     if args.plot:
         for sim in range(args.num_sim):
@@ -17,19 +17,24 @@ class SpringSim(object):
         self._delta_T = 0.001
         self._max_F = 0.1 / self._delta_T
 
+    def trajectory_energy(self, loc, vel, edges):
+        """
+        Compute the kinetic and potential energy of all time steps of a trajectory at once.
+        :param loc: [..., 2, N] locations, e.g. Tx2xN for a trajectory
+        :param vel: [..., 2, N] velocities
+        :param edges: NxN spring edges
+        :return: kinetic and potential energy, of shape [...]
+        """
+        kinetic = 0.5 * (vel ** 2).sum(axis=(-2, -1))
+        r = loc[..., :, :, np.newaxis] - loc[..., :, np.newaxis, :]
+        dist_squared = (r ** 2).sum(axis=-3)
+        off_diagonal = ~np.eye(loc.shape[-1], dtype=bool)
+        potential = (0.5 * self.interaction_strength * edges * dist_squared / 2 * off_diagonal).sum(axis=(-2, -1))
+        return kinetic, potential
+
     def _energy(self, loc, vel, edges):
-        # disables division by zero warning, since I fix it with fill_diagonal
-        with np.errstate(divide="ignore"):
-            K = 0.5 * (vel ** 2).sum() # kinetic energy
-            U = 0 # potential energy
-            for i in range(loc.shape[1]):
-                for j in range(loc.shape[1]):
-                    if i != j:
-                        r = loc[:, i] - loc[:, j]
-                        dist = np.sqrt((r ** 2).sum())
-                        U += 0.5 * self.interaction_strength * edges[
-                            i, j] * (dist ** 2) / 2
-            return U + K
+        kinetic, potential = self.trajectory_energy(loc, vel, edges)
+        return potential + kinetic
 
     def _clamp(self, loc, vel):
         '''
@@ -164,21 +169,27 @@ class ChargedParticlesSim(object):
         dist = A_norm + B_norm - 2 * A.dot(B.transpose())
         return dist
 
-    def _energy(self, loc, vel, edges):
-
-        # disables division by zero warning, since I fix it with fill_diagonal
+    def trajectory_energy(self, loc, vel, edges):
+        """
+        Compute the kinetic and potential energy of all time steps of a trajectory at once.
+        :param loc: [..., 2, N] locations, e.g. Tx2xN for a trajectory
+        :param vel: [..., 2, N] velocities
+        :param edges: NxN products of charges
+        :return: kinetic and potential energy, of shape [...]
+        """
+        kinetic = 0.5 * (vel ** 2).sum(axis=(-2, -1))
+        r = loc[..., :, :, np.newaxis] - loc[..., :, np.newaxis, :]
+        dist = np.sqrt((r ** 2).sum(axis=-3))
+        off_diagonal = ~np.eye(loc.shape[-1], dtype=bool)
+        # disables division by zero warning, since self interactions are masked
         with np.errstate(divide='ignore'):
+            inverse_dist = np.where(off_diagonal, 1 / dist, 0)
+        potential = (0.5 * self.interaction_strength * edges * inverse_dist).sum(axis=(-2, -1))
+        return kinetic, potential
 
-            K = 0.5 * (vel ** 2).sum()
-            U = 0
-            for i in range(loc.shape[1]):
-                for j in range(loc.shape[1]):
-                    if i != j:
-                        r = loc[:, i] - loc[:, j]
-                        dist = np.sqrt((r ** 2).sum())
-                        U += 0.5 * self.interaction_strength * edges[
-                            i, j] / dist
-            return U + K
+    def _energy(self, loc, vel, edges):
+        kinetic, potential = self.trajectory_energy(loc, vel, edges)
+        return potential + kinetic
 
     def _clamp(self, loc, vel):
         '''
@@ -300,7 +311,9 @@ if __name__ == '__main__':
         plt.plot(loc[:, 0, i], loc[:, 1, i])
         plt.plot(loc[0, 0, i], loc[0, 1, i], 'd')
     plt.figure()
-    energies = [sim._energy(loc[i, :, :], vel[i, :, :], edges) for i in
-                range(loc.shape[0])]
+    kinetic, potential = sim.trajectory_energy(loc, vel, edges)
+    energies = kinetic + potential
+    drift = (energies - energies[0]) / np.abs(energies[0])
+    print("Energy drift mean: {}, max: {}".format(np.abs(drift).mean(), np.abs(drift).max()))
     plt.plot(energies)
     plt.show()
\ No newline at end of file
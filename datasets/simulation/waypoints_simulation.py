@@ -49,39 +49,44 @@ def generate_group_trajectories(agents_per_group, num_steps, initial_velocity, i
     all_waypoints = waypoints + [final_position]
 
     steps = int((num_steps - 1) / len(all_waypoints))
-
-    # Simulate the trajectory for each agent in the group
-    for a in range(agents_per_group):
-        position = initial_positions[a, :]
-        positions[a, 0, :] = position
-        velocity = initial_velocities[a, :]
-        velocities[a, 0, :] = velocity
-
-        current_waypoint = initial_position
-        for i in range(len(all_waypoints)):
-            next_waypoint = all_waypoints[i]
-            # Calculate the direction vector towards the next waypoint
-            direction = next_waypoint - current_waypoint
-            distance = np.linalg.norm(direction)
-            direction /= distance
-            adjusted_velocity = distance / steps
-            velocity = direction * adjusted_velocity
-
-            # Update position based on velocity
-            for t in range(i * steps, (i + 1) * steps):
-                position += velocity + np.random.normal(scale=0.3, size=2)
-
-                # Store the updated position and velocity
-                positions[a, t + 1, :] = position
-                velocities[a, t + 1, :] = velocity
-                # Add small noise to the velocity vector
-                velocity += np.random.normal(scale=0.01, size=2)
-            current_waypoint = next_waypoint
-
-    for step in reversed(range(num_steps)):
-        if positions[0, step, 0] == 0 and positions[0, step, 1] == 0:
-            positions[:, step, :] = final_positions + np.random.normal(scale=0.3, size=2)
-            velocities[:, step, :] = velocity + np.random.normal(scale=0.01, size=2)
+    simulated_steps = len(all_waypoints) * steps
+
+    # Calculate the velocity towards each waypoint
+    waypoint_velocities = np.zeros((len(all_waypoints), 2), dtype=np.float64)
+    current_waypoint = initial_position
+    for i, next_waypoint in enumerate(all_waypoints):
+        # Calculate the direction vector towards the next waypoint
+        direction = next_waypoint - current_waypoint
+        distance = np.linalg.norm(direction)
+        direction /= distance
+        adjusted_velocity = distance / steps
+        waypoint_velocities[i] = direction * adjusted_velocity
+        current_waypoint = next_waypoint
+
+    # Draw the position noise and the velocity noise of every step of every agent at once,
+    # in the same order as a step by step simulation would
+    noise = np.random.normal(size=(agents_per_group, len(all_waypoints), steps, 2, 2))
+
+    # Velocities start from the waypoint velocity and accumulate small noise at each step
+    initial_waypoint_velocities = np.broadcast_to(waypoint_velocities[np.newaxis, :, np.newaxis, :],
+                                                  (agents_per_group, len(all_waypoints), 1, 2))
+    velocity_changes = np.concatenate((initial_waypoint_velocities, 0.01 * noise[:, :, :, 1, :]), axis=2)
+    waypoint_step_velocities = np.cumsum(velocity_changes, axis=2)
+    step_velocities = waypoint_step_velocities[:, :, :steps, :].reshape(agents_per_group, simulated_steps, 2)
+    # velocity of the last agent after its last step
+    velocity = waypoint_step_velocities[-1, -1, -1, :]
+
+    # Update positions based on velocities and noise
+    position_changes = step_velocities + 0.3 * noise[:, :, :, 0, :].reshape(agents_per_group, simulated_steps, 2)
+    positions[:, :simulated_steps + 1, :] = np.cumsum(
+        np.concatenate((initial_positions[:, np.newaxis, :], position_changes), axis=1), axis=1)
+    velocities[:, 0, :] = initial_velocities
+    velocities[:, 1:simulated_steps + 1, :] = step_velocities
+
+    # Remaining steps are filled around the final positions, from the last step backwards
+    remaining_noise = np.random.normal(size=(num_steps - simulated_steps - 1, 2, 2))[::-1]
+    positions[:, simulated_steps + 1:, :] = final_positions[:, np.newaxis, :] + 0.3 * remaining_noise[:, 0, :]
+    velocities[:, simulated_steps + 1:, :] = velocity + 0.01 * remaining_noise[:, 1, :]
 
     return positions, velocities
 
@@ -166,8 +171,6 @@ def get_simulation_dataframe(data, groups, frames_per_group):
     :param frames_per_group: number of data frames for each group
     :return: dataframe of simulation
     """
-    agent_dfs = []
-
     groups_per_start_frame = 2
     start_frame_values = [int(i * (frames_per_group / 2)) for i in range(int(len(groups) / groups_per_start_frame))]
     start_frame_values = [start_frame for start_frame in start_frame_values for _ in range(groups_per_start_frame)]
@@ -179,14 +182,11 @@ def get_simulation_dataframe(data, groups, frames_per_group):
         for agent in group:
             start_frames[agent] = start_frame
 
-    for agent in range(data.shape[0]):
-        start_frame = start_frames[agent]
-        agent_df = pd.DataFrame(data[agent].reshape(-1, 4), columns=['pos_x', 'pos_y', 'v_x', 'v_y'])
-        agent_df['agent_id'] = agent
-        agent_df['frame_id'] = [i + start_frame for i, _ in enumerate(agent_df['agent_id'])]
-        agent_dfs.append(agent_df)
-
-    df = pd.concat(agent_dfs, ignore_index=True)
+    agents, frames = data.shape[0], data.shape[1]
+    df = pd.DataFrame(data.reshape(-1, 4), columns=['pos_x', 'pos_y', 'v_x', 'v_y'])
+    df['agent_id'] = np.repeat(np.arange(agents), frames)
+    df['frame_id'] = np.tile(np.arange(frames), agents) + \
+        np.repeat(np.array([start_frames[agent] for agent in range(agents)], dtype=np.int64), frames)
 
     return df
 
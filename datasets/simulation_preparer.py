@@ -1,7 +1,6 @@
 import argparse
 import random
 from datetime import datetime
-from itertools import combinations
 
 import numpy as np
 import pandas as pd
@@ -9,8 +8,8 @@ import seaborn as sns
 import xlsxwriter
 from matplotlib import pyplot as plt
 
-from datasets.loader import read_sim, read_multi_groups
-from datasets.preparer import dataset_reformat, save_folds, get_scene_data
+from datasets.loader import read_sim, read_sims, read_multi_groups, get_group_ids, get_seed, merge_shards
+from datasets.preparer import dataset_reformat, get_scene_data, merge_chunks, save_samples, save_fold_indices
 
 
 def report(name, data):
@@ -102,19 +101,140 @@ def dataset_data(dataset_path, sample_frequency):
     }
 
 
-def get_group_pairs(groups):
+def get_frames_difference(frame_ids):
     """
-    Get pairs of agents that are in same group.
-    :param groups: list of groups
-    :return: list of pairs of agents
+    Get the difference between consecutive frame ids of a simulation.
+    :param frame_ids: sorted frame ids of the simulation
+    :return: difference between the first two frame ids, 1 if there are less than two frames
     """
-    scene_pairs = []
-    for scene_groups in groups:
-        pairs = []
-        for group in scene_groups:
-            pairs.extend(list(combinations(group, 2)))
-        scene_pairs.append(pairs)
-    return scene_pairs
+    if len(frame_ids) < 2:
+        return 1
+    return frame_ids[1] - frame_ids[0]
+
+
+def iter_sim_scenes(dataset_path, sample_frequency, frames_num, groups, chunk_size=100000):
+    """
+    Read the simulations of a dataset one at a time and get their scenes.
+    :param dataset_path: string of where to find dataset
+    :param sample_frequency: frame ids between the start of two simulations
+    :param frames_num: number of frames in a scene
+    :param groups: list of groups of every simulation
+    :param chunk_size: number of rows to read at a time
+    :return: generator of (sim, trajectory index, scenes) tuples
+    """
+    for sim, index in read_sims(dataset_path, sample_frequency, chunk_size, dtype=np.float64):
+        difference = get_frames_difference(index['frame_ids'])
+        # every window of the simulation is needed, otherwise each simulation would lose its last one
+        scenes = get_scene_data(dataframe=None, consecutive_frames=frames_num, difference_between_frames=difference,
+                                groups=groups, step=1, sim=True, index=index, all_windows=True)
+        yield sim, index, scenes
+
+
+def check_sim_scenes(dataset_path, sample_frequency, frames_num, groups, chunk_size=100000):
+    """
+    Check that reading the simulations one at a time gives the same number of scenes as reading the whole dataset.
+    :param dataset_path: string of where to find dataset
+    :param sample_frequency: frame ids between the start of two simulations
+    :param frames_num: number of frames in a scene
+    :param groups: list of groups of every simulation
+    :param chunk_size: number of rows to read at a time
+    :return: number of scenes
+    """
+    streamed = sum(len(scenes) for _, _, scenes in iter_sim_scenes(dataset_path, sample_frequency, frames_num, groups,
+                                                                   chunk_size))
+    index = read_sim(dataset_path, sample_frequency, columnar=True)
+    difference = get_frames_difference(index['frame_ids'])
+    whole = len(get_scene_data(dataframe=None, consecutive_frames=frames_num, difference_between_frames=difference,
+                               groups=groups, step=1, sim=True, index=index, all_windows=True))
+    if streamed != whole:
+        raise ValueError('{} scenes read per simulation, {} from the whole dataset'.format(streamed, whole))
+    return whole
+
+
+def iter_sim_samples(dataset, dataset_path, sample_frequency, frames_num, agents_num, groups, shift, seed,
+                     chunk_size=100000):
+    """
+    Read the simulations of a dataset one at a time and reformat their scenes. The random generators are seeded for
+    every simulation, so samples do not depend on how simulations are read.
+    :param dataset: name of the dataset
+    :param dataset_path: string of where to find dataset
+    :param sample_frequency: frame ids between the start of two simulations
+    :param frames_num: number of frames in a scene
+    :param agents_num: number of agents in a sample
+    :param groups: list of groups of every simulation
+    :param shift: True if to transform context according to pair coordinates, otherwise False
+    :param seed: global seed
+    :param chunk_size: number of rows to read at a time
+    :return: generator of reformatted simulations
+    """
+    for sim, index, scenes in iter_sim_scenes(dataset_path, sample_frequency, frames_num, groups, chunk_size):
+        sim_seed = get_seed(seed, dataset, sim)
+        random.seed(sim_seed)
+        np.random.seed(sim_seed)
+        yield dataset_reformat(dataframe=None, scene_data=scenes, agents_num=agents_num, min_pair_samples=1,
+                               max_pair_samples=1, shift=shift, index=index,
+                               group_ids=get_group_ids(groups[sim], index['agent_ids']))
+
+
+def save_shard(path, shards, chunks, frames_num):
+    """
+    Save reformatted simulations in a new shard of the dataset.
+    :param path: folder of the dataset
+    :param shards: folders of the shards saved so far, the new shard is appended
+    :param chunks: list of reformatted simulations
+    :param frames_num: number of frames in a scene
+    :return: number of samples in the shard
+    """
+    if len(chunks) == 0:
+        return 0
+    data, labels, frames, groups = merge_chunks(chunks)
+    if len(data) == 0:
+        return 0
+    shards.append('{}/shards/shard_{}'.format(path, len(shards)))
+    save_samples(shards[-1], data, labels, frames, groups, frames_num)
+    return len(data)
+
+
+def prepare_sim_dataset(dataset, dataset_path, save_folder, sample_frequency, frames_num, agents_num, shift, seed,
+                        sims_per_shard=100, chunk_size=100000):
+    """
+    Reformat a simulation dataset one simulation at a time and save it in folds. Samples are appended to shards on
+    disk every sims_per_shard simulations and the shards are merged at the end, so memory does not grow with the
+    number of simulations.
+    :param dataset: name of the dataset
+    :param dataset_path: string of where to find dataset
+    :param save_folder: folder to save the folds
+    :param sample_frequency: frame ids between the start of two simulations
+    :param frames_num: number of frames in a scene
+    :param agents_num: number of agents in a sample
+    :param shift: True if to transform context according to pair coordinates, otherwise False
+    :param seed: global seed
+    :param sims_per_shard: number of simulations in a shard
+    :param chunk_size: number of rows to read at a time
+    :return: number of samples
+    """
+    groups = read_multi_groups(dataset_path)
+    dataset_name = '{}_shifted'.format(dataset) if shift else dataset
+    path = '{}/{}_{}_{}'.format(save_folder, dataset_name, frames_num, agents_num)
+
+    shards = []
+    chunks = []
+    samples = 0
+    sim_samples = iter_sim_samples(dataset, dataset_path, sample_frequency, frames_num, agents_num, groups, shift, seed,
+                                   chunk_size)
+    for chunk in sim_samples:
+        chunks.append(chunk)
+        if len(chunks) == sims_per_shard:
+            samples += save_shard(path, shards, chunks, frames_num)
+            chunks = []
+    samples += save_shard(path, shards, chunks, frames_num)
+    if samples == 0:
+        raise ValueError('no samples of {} frames with {} agents in {}'.format(frames_num, agents_num, dataset_path))
+
+    merge_shards('{}/samples'.format(path), shards)
+    save_fold_indices(path, np.load('{}/samples/frames.npy'.format(path)),
+                      np.load('{}/samples/group_frames.npy'.format(path)), multi_frame=frames_num > 1)
+    return samples
 
 
 def get_args():
@@ -130,6 +250,9 @@ def get_args():
     parser.add_argument('-p', '--plot', action="store_true", default=True)
     parser.add_argument('-s', '--shift', action="store_true", default=True)
     parser.add_argument('-r', '--report', action="store_true", default=False)
+    parser.add_argument('-ss', '--sims_per_shard', type=int, default=100)
+    parser.add_argument('-cs', '--chunk_size', type=int, default=100000)
+    parser.add_argument('-c', '--check', action="store_true", default=False)
 
     return parser.parse_args()
 
@@ -143,54 +266,36 @@ if __name__ == '__main__':
     random.seed(args.seed)
     np.random.seed(args.seed)
 
-    # create datasets report
-    datasets_dict = {
-        'sim_1': dataset_data('./simulation/sim_10_3_5', args.samples_freq)
+    datasets_paths = {
+        'sim_1': './simulation/sim_10_3_5'
     }
+
+    # create datasets report
     if args.report:
+        datasets_dict = {dataset: dataset_data(path, args.samples_freq) for dataset, path in datasets_paths.items()}
         report('datasets.xlsx', datasets_dict)
 
     # create datasets group size histogram
-    groups_dict = {
-        'sim_1': read_multi_groups('./simulation/sim_10_3_5')
-    }
+    groups_dict = {dataset: read_multi_groups(path) for dataset, path in datasets_paths.items()}
     if args.plot:
         groups_size_hist(groups_dict, './group_size_plot.png')
 
-    multi_frame = True
-    if args.frames_num == 1:
-        multi_frame = False
-
-    for dataset in datasets_dict.keys():
+    for dataset, dataset_path in datasets_paths.items():
         dataset_start = datetime.now()
         print('Dataset: {}, started at: {}'.format(dataset, dataset_start))
 
-        df = datasets_dict[dataset]['df']
-        groups = datasets_dict[dataset]['groups']
-        difference = datasets_dict[dataset]['difference']
-
-        group_pairs = get_group_pairs(groups)
-
-        scenes = get_scene_data(dataframe=df, consecutive_frames=args.frames_num, difference_between_frames=difference,
-                                groups=groups, step=1)
-
-        # format dataset to be used by proposed approach
-        data, labels, frames, filtered_groups = dataset_reformat(dataframe=df,
-                                                                 scene_data=scenes,
-                                                                 groups=groups,
-                                                                 group_pairs=group_pairs,
-                                                                 agents_num=args.agents_num,
-                                                                 shift=args.shift,
-                                                                 min_pair_samples=1,
-                                                                 max_pair_samples=1)
-        dataset = '{}_shifted'.format(dataset) if args.shift else dataset
-        # save dataset in folds
-        save_folds(args.save_folder, dataset, args.frames_num, args.agents_num, data, labels, frames,
-                   filtered_groups, multi_frame)
+        if args.check:
+            scenes_num = check_sim_scenes(dataset_path, args.samples_freq, args.frames_num, groups_dict[dataset],
+                                          args.chunk_size)
+            print('\tscenes: {}'.format(scenes_num))
+
+        # format dataset to be used by proposed approach and save it in folds
+        data_size = prepare_sim_dataset(dataset, dataset_path, args.save_folder, args.samples_freq, args.frames_num,
+                                        args.agents_num, args.shift, args.seed, args.sims_per_shard, args.chunk_size)
 
         end = datetime.now()
         print('Dataset: {}, finished in: {}'.format(dataset, end - dataset_start))
-        print('\tdata size: {}'.format(len(data)))
+        print('\tdata size: {}'.format(data_size))
         dataset_start = end
 
     end = datetime.now()
@@ -1,5 +1,9 @@
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+
 from sklearn.cluster import DBSCAN
 
+from datasets.loader import get_seed
 from models.DANTE.dominant_sets import *
 from models.gmitre import compute_groupMitre
 
@@ -112,8 +116,8 @@ def labels_to_groups(labels):
     return groups
 
 
-def dbscan_algo(predictions, n_people, frames):
-    A, agents_map = learned_affinity_clone(predictions, n_people, frames)
+def dbscan_algo(predictions, n_people, frames, indices=None):
+    A, agents_map = learned_affinity_clone(predictions, n_people, frames, indices)
 
     dbscan = DBSCAN(eps=1, min_samples=2)
     labels = dbscan.fit_predict(A)
@@ -123,64 +127,265 @@ def dbscan_algo(predictions, n_people, frames):
     return groups, agents_map
 
 
-def F1_calc_clone(group_thresholds, affinities, frames, groups, positions, multi_frame=False,
-                  non_reusable=False, dominant_sets=True, eps_thres=1e-15):
+def get_scenes(frames, multi_frame=False):
     """
-    Calculates average F1 for thresholds 2/3, 1 and group mitre.
-    :param group_thresholds: threshold for group to be considered correctly detected
-    :param affinities: predicted affinities
+    Finds the scenes of the samples.
     :param frames: list of frames
-    :param groups: list of groups per scene
-    :param positions: data in raw format
     :param multi_frame: True if scenes include multiple frames, otherwise False
-    :param non_reusable: if predicted groups can be reused
-    :param dominant_sets: True if dominant sets algorithm will be used, otherwise False
-    :param eps_thres: threshold to be used in vector climb of dominant sets
-    :param dominant_sets: True if dominant sets algorithm will be used, otherwise False
-    :return: list of F1, precision, recall for T=2/3, T=1 and group mitre
+    :return: list of tuples with the frames and the sample indices of every scene
     """
-    avg_results = [np.array([0.0, 0.0]) for _ in range(len(group_thresholds))]
-
-    num_times = 1
     frame_ids = [frame[0] for frame in frames]
 
     if multi_frame:
-        frame_values = [list(x) for x in set(tuple(frame_id) for frame_id in frame_ids)]
+        keys = [tuple(frame_id) for frame_id in frame_ids]
+        frame_values = [list(x) for x in set(keys)]
     else:
+        keys = np.asarray(frame_ids).reshape(len(frame_ids), -1)[:, 0].tolist()
         frame_values = np.unique(frame_ids)
-    for unique_frame in frame_values:
-        idx = [i for i, frame in enumerate(frame_ids) if frame == unique_frame]
-        predictions = affinities[idx].flatten()
 
+    scene_samples = {}
+    for i, key in enumerate(keys):
+        scene_samples.setdefault(key, []).append(i)
+    return [(unique_frame, scene_samples[tuple(unique_frame) if multi_frame else unique_frame])
+            for unique_frame in frame_values]
+
+
+def get_scene_pair_indices(frames, scenes):
+    """
+    Maps the pairs of the samples of every scene to indices of the agents in the scene, so that affinity matrices
+    can be filled without searching for the agents.
+    :param frames: list of frames
+    :param scenes: scenes from get_scenes
+    :return: list of agent ids and pair indices of every scene
+    """
+    pairs = np.array([frame[1] for frame in frames]).reshape(len(frames), 2)
+    return [get_pair_indices(pairs[idx]) for _, idx in scenes]
+
+
+def get_evaluation_plan(frames, groups, positions, multi_frame=False):
+    """
+    Precomputes everything of the evaluation of a split that does not depend on the predictions, so that only
+    clustering and scoring are left for every evaluation.
+    :param frames: list of frames
+    :param groups: list of groups per scene
+    :param positions: trajectory index of the dataset
+    :param multi_frame: True if scenes include multiple frames, otherwise False
+    :return: list of dictionaries with the frames, sample indices, number of agents, pair indices, agent mapping
+    and ground truth groups, including single agent groups, of every scene
+    """
+    scenes = get_scenes(frames, multi_frame)
+    pair_indices = get_scene_pair_indices(frames, scenes)
+
+    # ground truth groups of every scene, the first ones if a scene appears multiple times
+    scene_groups = {}
+    for group in groups:
+        key = tuple(group[0]) if multi_frame else np.ravel(group[0])[0]
+        scene_groups.setdefault(key, group[1])
+
+    plan = []
+    for (unique_frame, idx), indices in zip(scenes, pair_indices):
         if multi_frame:
-            agents_by_frame = positions.groupby('frame_id')['agent_id'].apply(list).reset_index(name='agents')
-            agent_list = \
-                [set(agents_by_frame[agents_by_frame['frame_id'] == frame]['agents'].iloc[0]) for frame in unique_frame]
-            n_people = len(set.intersection(*agent_list))
+            frame_idx = [positions['frames'][frame] for frame in unique_frame]
+            n_people = np.count_nonzero(positions['present'][:, frame_idx].all(axis=1))
         else:
-            n_people = len(positions[positions.frame_id == unique_frame])
+            n_people = np.count_nonzero(positions['present'][:, positions['frames'][unique_frame]])
 
+        agents_map = {number: agent for number, agent in enumerate(indices[0])}
+        # copy, so that adding the single agent groups leaves the given groups untouched
+        groups_at_time = list(scene_groups[tuple(unique_frame) if multi_frame else unique_frame])
+        include_single_agent_groups(groups_at_time, agents_map.values())
+        plan.append({
+            'frame': unique_frame,
+            'samples': np.array(idx),
+            'n_people': n_people,
+            'indices': indices,
+            'agents_map': agents_map,
+            'groups': groups_at_time
+        })
+    return plan
+
+
+def evaluate_scenes(plan, scene_predictions, group_thresholds, non_reusable=False, dominant_sets=True,
+                    eps_thres=1e-15, rngs=None):
+    """
+    Clusters the scenes of an evaluation plan and scores the predicted groups.
+    :param plan: list of scenes from get_evaluation_plan
+    :param scene_predictions: predicted affinities of every scene
+    :param group_thresholds: threshold for group to be considered correctly detected
+    :param non_reusable: if predicted groups can be reused
+    :param dominant_sets: True if dominant sets algorithm will be used, otherwise False
+    :param eps_thres: threshold to be used in vector climb of dominant sets
+    :param rngs: random generators of the scenes for dominant sets, np.random is used if not given
+    :return: [scenes, thresholds, 2] array of precision and recall
+    """
+    results = np.zeros((len(plan), len(group_thresholds), 2))
+    if dominant_sets:
+        # cluster all scenes at once
+        scene_groups = iterate_climb_learned_batch(
+            [learned_affinity_clone(predictions, scene['n_people'], None, scene['indices'])[0]
+             for scene, predictions in zip(plan, scene_predictions)], eps_thres=eps_thres, rngs=rngs)
+
+    for i, scene in enumerate(plan):
         if dominant_sets:
-            bool_groups, agents_map = iterate_climb_learned(predictions, n_people, frames[idx], new=True,
-                                                            eps_thres=eps_thres)
+            bool_groups = scene_groups[i]
         else:
-            bool_groups, agents_map = dbscan_algo(predictions, n_people, frames[idx])
-            # bool_groups, agents_map = naive_group(predictions, n_people, frames[idx], new=True)
+            bool_groups, _ = dbscan_algo(scene_predictions[i], scene['n_people'], None, scene['indices'])
+            # bool_groups, _ = naive_group(predictions, n_people, frames[idx], new=True)
 
-        groups_at_time = [group[1] for group in groups if group[0] == unique_frame][0]
-        include_single_agent_groups(groups_at_time, agents_map.values())
-        predicted_groups = group_names_clone(bool_groups, agents_map, n_people)
+        agents_map = scene['agents_map']
+        groups_at_time = scene['groups']
+        predicted_groups = group_names_clone(bool_groups, agents_map, scene['n_people'])
         include_single_agent_groups(predicted_groups, agents_map.values())
-        for i, T in enumerate(group_thresholds):
+        for j, T in enumerate(group_thresholds):
             if T is None:
                 precision, recall, _ = compute_groupMitre(groups_at_time, predicted_groups)
             else:
                 _, _, _, precision, recall = group_correctness(
                     predicted_groups, groups_at_time, T, non_reusable=non_reusable)
-            avg_results[i] += np.array([precision, recall])
-        num_times += 1
+            results[i, j] = precision, recall
+    return results
 
-    return calculate_f1(avg_results, num_times)
+
+worker_evaluation = {}
+
+
+def init_worker(plan, buffer_name, n_samples):
+    """
+    Share the evaluation plan and the shared memory buffer of the predictions with a pool worker.
+    :param plan: list of scenes from get_evaluation_plan
+    :param buffer_name: name of the shared memory buffer of the predictions
+    :param n_samples: number of samples
+    :return: nothing
+    """
+    buffer = SharedMemory(name=buffer_name)
+    worker_evaluation.update(plan=plan, buffer=buffer, predictions=np.ndarray((n_samples,), np.float64, buffer.buf))
+
+
+def evaluate_chunk(task, evaluation=None):
+    """
+    Clusters and scores a chunk of scenes.
+    :param task: tuple of scene numbers, seed and evaluate_scenes keyword arguments
+    :param evaluation: dictionary with the plan and predictions, the ones shared with the worker if not given
+    :return: [scenes, thresholds, 2] array of precision and recall
+    """
+    if evaluation is None:
+        evaluation = worker_evaluation
+    scenes, seed, params = task
+    plan = [evaluation['plan'][scene] for scene in scenes]
+    predictions = evaluation['predictions']
+    rngs = [np.random.RandomState(get_seed(seed, scene)) for scene in scenes]
+    return evaluate_scenes(plan, [predictions[scene['samples']] for scene in plan], rngs=rngs, **params)
+
+
+def create_evaluation_pool(plan, n_samples, workers=1, seed=0, chunk_size=16):
+    """
+    Creates the worker pool and the shared memory buffer of the predictions used to evaluate the scenes of a plan.
+    Scenes are split in chunks of fixed size, and dominant sets of every scene use a random generator seeded from the
+    global seed, so results do not depend on the number of workers. Workers are spawned, so the calling script must
+    guard its entry point with if __name__ == '__main__'.
+    :param plan: list of scenes from get_evaluation_plan
+    :param n_samples: number of samples of the predictions
+    :param workers: number of worker processes, chunks are evaluated in this process if 1
+    :param seed: global seed of the scene random generators
+    :param chunk_size: number of scenes evaluated by a task
+    :return: dictionary of pool, buffer, plan, predictions, seed and chunk size
+    """
+    pool, buffer = None, None
+    if workers > 1:
+        buffer = SharedMemory(create=True, size=max(n_samples, 1) * np.dtype(np.float64).itemsize)
+        # workers are spawned, as forking after keras has started its threads is not safe
+        pool = get_context('spawn').Pool(workers, initializer=init_worker, initargs=(plan, buffer.name, n_samples))
+        predictions = np.ndarray((n_samples,), np.float64, buffer.buf)
+    else:
+        predictions = np.zeros(n_samples)
+    return {
+        'pool': pool,
+        'buffer': buffer,
+        'plan': plan,
+        'predictions': predictions,
+        'seed': seed,
+        'chunk_size': chunk_size
+    }
+
+
+def close_evaluation_pool(evaluation_pool):
+    """
+    Stops the workers and releases the shared memory buffer of an evaluation pool.
+    :param evaluation_pool: evaluation pool from create_evaluation_pool
+    :return: nothing
+    """
+    if evaluation_pool['pool'] is not None:
+        evaluation_pool['pool'].close()
+        evaluation_pool['pool'].join()
+    del evaluation_pool['predictions']
+    if evaluation_pool['buffer'] is not None:
+        evaluation_pool['buffer'].close()
+        evaluation_pool['buffer'].unlink()
+
+
+def evaluate_scenes_parallel(evaluation_pool, affinities, group_thresholds, non_reusable=False, dominant_sets=True,
+                             eps_thres=1e-15):
+    """
+    Clusters and scores the scenes of the plan of an evaluation pool in its workers, or in this process if it has
+    none.
+    :param evaluation_pool: evaluation pool from create_evaluation_pool
+    :param affinities: predicted affinities
+    :param group_thresholds: threshold for group to be considered correctly detected
+    :param non_reusable: if predicted groups can be reused
+    :param dominant_sets: True if dominant sets algorithm will be used, otherwise False
+    :param eps_thres: threshold to be used in vector climb of dominant sets
+    :return: [scenes, thresholds, 2] array of precision and recall
+    """
+    evaluation_pool['predictions'][:] = np.reshape(affinities, len(evaluation_pool['predictions']))
+
+    params = {'group_thresholds': group_thresholds, 'non_reusable': non_reusable, 'dominant_sets': dominant_sets,
+              'eps_thres': eps_thres}
+    scenes = np.arange(len(evaluation_pool['plan']))
+    chunk_size = evaluation_pool['chunk_size']
+    tasks = [(scenes[start:start + chunk_size], evaluation_pool['seed'], params)
+             for start in range(0, len(scenes), chunk_size)]
+    if evaluation_pool['pool'] is not None:
+        results = evaluation_pool['pool'].map(evaluate_chunk, tasks, chunksize=1)
+    else:
+        results = [evaluate_chunk(task, evaluation_pool) for task in tasks]
+    return np.concatenate(results) if len(results) > 0 else np.zeros((0, len(group_thresholds), 2))
+
+
+def F1_calc_clone(group_thresholds, affinities, frames, groups, positions, multi_frame=False,
+                  non_reusable=False, dominant_sets=True, eps_thres=1e-15, plan=None, evaluation_pool=None):
+    """
+    Calculates average F1 for thresholds 2/3, 1 and group mitre.
+    :param group_thresholds: threshold for group to be considered correctly detected
+    :param affinities: predicted affinities
+    :param frames: list of frames
+    :param groups: list of groups per scene
+    :param positions: trajectory index of the dataset
+    :param multi_frame: True if scenes include multiple frames, otherwise False
+    :param non_reusable: if predicted groups can be reused
+    :param dominant_sets: True if dominant sets algorithm will be used, otherwise False
+    :param eps_thres: threshold to be used in vector climb of dominant sets
+    :param plan: evaluation plan of the split from get_evaluation_plan, computed if not given
+    :param evaluation_pool: evaluation pool from create_evaluation_pool, built with the plan of the split, to
+    evaluate the scenes in chunks with dominant sets seeded per scene
+    :return: list of F1, precision, recall for T=2/3, T=1 and group mitre
+    """
+    avg_results = [np.array([0.0, 0.0]) for _ in range(len(group_thresholds))]
+
+    if evaluation_pool is not None:
+        results = evaluate_scenes_parallel(evaluation_pool, affinities, group_thresholds, non_reusable=non_reusable,
+                                           dominant_sets=dominant_sets, eps_thres=eps_thres)
+    else:
+        if plan is None:
+            plan = get_evaluation_plan(frames, groups, positions, multi_frame)
+        results = evaluate_scenes(plan, [affinities[scene['samples']].flatten() for scene in plan], group_thresholds,
+                                  non_reusable=non_reusable, dominant_sets=dominant_sets, eps_thres=eps_thres)
+
+    # scenes are added in order, so that the averages do not depend on how they were evaluated
+    for scene_results in results:
+        for j in range(len(group_thresholds)):
+            avg_results[j] += scene_results[j]
+
+    return calculate_f1(avg_results, len(results) + 1)
 
 
 def group_correctness(guesses, truth, T, non_reusable=False):
@@ -1,4 +1,4 @@
-from collections import Counter
+import time
 
 import numpy as np
 
@@ -31,33 +31,42 @@ def learned_affinity(truth_arr, n_people, frame, n_features):
     return A
 
 
-def learned_affinity_clone(truth_arr, n_people, frames):
+def get_pair_indices(pairs):
+    """
+    Maps the agent ids of pairs to indices of the agents in the scene.
+    :param pairs: agent ids of the pairs, of shape (pairs, 2)
+    :return: sorted agent ids and indices of the pairs, of shape (pairs, 2)
+    """
+    pairs = np.asarray(pairs).reshape(-1, 2)
+    agents, indices = np.unique(pairs, return_inverse=True)
+    return agents, indices.reshape(-1, 2)
+
+
+def learned_affinity_clone(truth_arr, n_people, frames, indices=None):
     """
     Fills an n_people x n_people matrix with affinity values.
+    The predictions of every pair are added to both directions, and both directions are divided by the count of
+    every pair.
     :param truth_arr: predicted affinities
     :param n_people: number of agents
     :param frames: frames included in examined scene
+    :param indices: agent ids and pair indices of the scene from get_pair_indices, computed from frames if not given
     :return:
     """
-    A = np.zeros((n_people, n_people))
+    if indices is None:
+        indices = get_pair_indices([frame[1] for frame in frames])
+    agents, pair_indices = indices
+    i, j = pair_indices[:, 0], pair_indices[:, 1]
 
-    frame_pairs = [frame[1] for frame in frames]
-    agents = np.unique(frame_pairs)
-    agents_map = {value: number for number, value in enumerate(agents)}
-
-    for idx, pair in enumerate(frame_pairs):
-        i = agents_map[pair[0]]
-        j = agents_map[pair[1]]
-        A[i, j] += truth_arr[idx]
-        A[j, i] += truth_arr[idx]
+    A = np.zeros((n_people, n_people))
+    np.add.at(A, (i, j), truth_arr)
+    np.add.at(A, (j, i), truth_arr)
 
-    for pair, count in Counter(frame_pairs).items():
-        i = agents_map[pair[0]]
-        j = agents_map[pair[1]]
-        A[i, j] = A[i, j] / count
-        A[j, i] = A[j, i] / count
+    counts = np.bincount(i * n_people + j, minlength=n_people * n_people).reshape(n_people, n_people)
+    counts[counts == 0] = 1
+    A /= counts * counts.T
 
-    return A, {value: key for key, value in agents_map.items()}
+    return A, {number: agent for number, agent in enumerate(agents)}
 
 
 # optimization function
@@ -80,8 +89,8 @@ def phi(S, i, j, A):
     return A[i, j] - k(S, i, A)
 
 
-# d-sets function weight
-def weight(S, i, A, depth):
+# d-sets function weight, recursive reference of candidate_weights
+def recursive_weight(S, i, A, depth):
     if np.sum(S) == 1 or depth > 2:
         return 1
     else:
@@ -90,13 +99,52 @@ def weight(S, i, A, depth):
         sum_weights = 0
         for j in range(len(R)):
             if R[j]:
-                sum_weights += phi(R, j, i, A) * weight(R, j, A, depth + 1)
+                sum_weights += phi(R, j, i, A) * recursive_weight(R, j, A, depth + 1)
         return sum_weights
 
 
+def candidate_weights(S, candidates, A):
+    """
+    Computes the d-sets weight of set S for every candidate person outside of S at once, in closed form for the
+    three levels of recursion of recursive_weight. The row sums of A over S, that k needs for S and its subsets,
+    are computed once and shared by all candidates.
+    :param S: boolean mask of the people of the set
+    :param candidates: people outside of S
+    :param A: affinity matrix
+    :return: weights of the candidates
+    """
+    candidates = np.asarray(candidates, dtype=int)
+    members = np.flatnonzero(S)
+    c = len(members)
+    if c == 1:
+        return np.ones(len(candidates))
+
+    B = A[np.ix_(members, members)]
+    row_sums = B.sum(axis=1)
+    # weights of the members l in S without j, from the sums over m of phi(S - {j, l}, m, l)
+    if c == 2:
+        W2 = np.ones((c, c))
+    else:
+        col_sums = B.sum(axis=0)
+        diagonal = np.diag(B)
+        # sums over all m, without the terms of m = j and m = l
+        W2 = col_sums[np.newaxis, :] - (row_sums.sum() - col_sums[:, np.newaxis] - col_sums[np.newaxis, :]) / (c - 2)
+        W2 -= B - (row_sums[:, np.newaxis] - diagonal[:, np.newaxis] - B) / (c - 2)
+        W2 -= diagonal[np.newaxis, :] - (row_sums[np.newaxis, :] - B.T - diagonal[np.newaxis, :]) / (c - 2)
+    # weights of the members j in S, from phi(S - {j}, l, j) for every other member l
+    terms = (B.T - (row_sums[np.newaxis, :] - B.T) / (c - 1)) * W2
+    np.fill_diagonal(terms, 0)
+    W1 = terms.sum(axis=1)
+
+    # phi(S, j, i) for every member j and candidate i
+    phi_0 = A[np.ix_(members, candidates)] - (row_sums / c)[:, np.newaxis]
+    return phi_0.T.dot(W1)
+
+
 # iteratively finds vector x which maximizes f
-def vector_climb(A, allowed, n_people, original_A, thres=1e-5, eps_thres=1e-15):
-    x = np.random.uniform(0, 1, n_people)
+def vector_climb(A, allowed, n_people, original_A, thres=1e-5, eps_thres=1e-15, x=None):
+    if x is None:
+        x = np.random.uniform(0, 1, n_people)
     x = np.multiply(x, allowed)
     eps = 10
     counter = 0
@@ -109,10 +157,8 @@ def vector_climb(A, allowed, n_people, original_A, thres=1e-5, eps_thres=1e-15):
 
     groups = x > thres
 
-    for i in range(n_people):
-        if not allowed[i]:
-            if weight(groups, i, original_A, 0) > 0.0:
-                return []
+    if np.any(candidate_weights(groups, np.flatnonzero(allowed == 0), original_A) > 0.0):
+        return []
     return groups
 
 
@@ -153,6 +199,96 @@ def iterate_climb_learned(predictions, n_people, frames, n_features=None, new=Fa
         return groups
 
 
+def vector_climb_batch(A, allowed, valid, original_A, thres=1e-5, eps_thres=1e-15, x=None):
+    """
+    Runs vector_climb for a batch of scenes at once, with affinity matrices padded to the same number of people.
+    Scenes stop being updated as soon as they converge.
+    :param A: [S, n, n] affinity matrices, with the rows and columns of people that are not allowed set to 0
+    :param allowed: [S, n] people that can still be added to a group
+    :param valid: [S, n] people of every scene, False for padding
+    :param original_A: [S, n, n] affinity matrices of the scenes
+    :param thres: threshold of x for a person to be included in the group
+    :param eps_thres: threshold of the change of f for a scene to converge
+    :param x: [S, n] initial vectors, uniformly random if not given
+    :return: [S, n] groups and [S] mask of the groups that were accepted
+    """
+    if x is None:
+        x = np.random.uniform(0, 1, allowed.shape)
+    x = np.multiply(x, allowed)
+
+    # f(x) of the current x is kept, so that every iteration needs one product with A
+    Ax = np.matmul(A, x[:, :, np.newaxis])[:, :, 0]
+    f_x = np.sum(x * Ax, axis=1)
+    scenes = np.arange(len(x))
+    scene_A = A
+    counter = 0
+    while len(scenes) > 0 and counter <= 10000:
+        x_next = x[scenes] * Ax / f_x[:, np.newaxis]
+        Ax = np.matmul(scene_A, x_next[:, :, np.newaxis])[:, :, 0]
+        f_x_next = np.sum(x_next * Ax, axis=1)
+        eps = np.abs(f_x_next - f_x)
+        x[scenes] = x_next
+        f_x = f_x_next
+        counter += 1
+
+        running = eps > eps_thres
+        if not running.all():
+            scenes, scene_A, Ax, f_x = scenes[running], scene_A[running], Ax[running], f_x[running]
+
+    groups = x > thres
+
+    accepted = np.array([not np.any(candidate_weights(groups[scene], np.flatnonzero(valid[scene] & (allowed[scene] == 0)),
+                                                      original_A[scene]) > 0.0)
+                         for scene in range(len(groups))], dtype=bool)
+    return groups, accepted
+
+
+def iterate_climb_learned_batch(affinities, eps_thres=1e-15, rngs=None):
+    """
+    Finds vectors x of people which maximize f for all scenes at once. Then removes those people and repeats.
+    :param affinities: list of affinity matrices of the scenes, e.g. from learned_affinity_clone
+    :param eps_thres: threshold to be used in vector climb of dominant sets
+    :param rngs: list of random generators of the scenes for the initial vectors x, np.random is used if not given
+    :return: list of groups of every scene
+    """
+    if len(affinities) == 0:
+        return []
+    n_people = max(len(A) for A in affinities)
+
+    # pad the affinity matrices of all scenes to the same size
+    original_A = np.zeros((len(affinities), n_people, n_people))
+    valid = np.zeros((len(affinities), n_people), dtype=bool)
+    for scene, A in enumerate(affinities):
+        original_A[scene, :len(A), :len(A)] = A
+        valid[scene, :len(A)] = True
+    allowed = valid.astype(float)
+    groups = [[] for _ in affinities]
+
+    scenes = np.arange(len(affinities))
+    while len(scenes) > 0:
+        scene_allowed = allowed[scenes]
+        A = original_A[scenes] * scene_allowed[:, :, np.newaxis] * scene_allowed[:, np.newaxis, :]
+        running = (np.sum(scene_allowed, axis=1) > 1) & (np.sum(A, axis=(1, 2)) != 0)
+        scenes, A = scenes[running], A[running]
+        if len(scenes) == 0:
+            break
+
+        x = None
+        if rngs is not None:
+            # every scene draws from its own generator, so that its groups do not depend on the other scenes
+            x = np.zeros((len(scenes), n_people))
+            for row, scene in enumerate(scenes):
+                x[row, :len(affinities[scene])] = rngs[scene].uniform(0, 1, len(affinities[scene]))
+        x, accepted = vector_climb_batch(A, allowed[scenes], valid[scenes], original_A[scenes], thres=1e-5,
+                                         eps_thres=eps_thres, x=x)
+        scenes, x = scenes[accepted], x[accepted]
+        for scene, group in zip(scenes, x):
+            groups[scene].append(group[:len(affinities[scene])])
+        allowed[scenes] = np.multiply(x == False, allowed[scenes])
+
+    return groups
+
+
 # Groups according to the algorithm in "Recognizing F-Formations in the Open World"
 # https://ieeexplore.ieee.org/abstract/document/8673233
 def naive_group(predictions, n_people, frames, n_features=None, new=False):
@@ -194,3 +330,26 @@ def naive_group(predictions, n_people, frames, n_features=None, new=False):
         return groups, agents_map
     else:
         return groups
+
+
+if __name__ == '__main__':
+    # microbenchmark of the d-sets weights of all people outside of a set, against the recursive reference
+    np.random.seed(0)
+    for n_people in [5, 10, 20, 30, 40, 50, 60]:
+        A = np.random.uniform(0, 1, (n_people, n_people))
+        A = (A + A.T) / 2
+        S = np.zeros(n_people, dtype=bool)
+        S[np.random.choice(n_people, min(n_people // 3 + 1, 10), replace=False)] = True
+        candidates = np.flatnonzero(S == False)
+
+        start = time.time()
+        recursive_decisions = np.array([recursive_weight(S, i, A, 0) > 0.0 for i in candidates])
+        recursive_time = time.time() - start
+        start = time.time()
+        decisions = candidate_weights(S, candidates, A) > 0.0
+        vectorized_time = time.time() - start
+
+        same_decisions = np.array_equal(decisions, recursive_decisions)
+        print('agents: {}, set size: {}, recursive: {:.4f}s, vectorized: {:.5f}s, speedup: {:.0f}, '
+              'same decisions: {}'.format(n_people, np.sum(S), recursive_time, vectorized_time,
+                                          recursive_time / vectorized_time, same_decisions))
@@ -9,7 +9,7 @@ from keras.models import Model
 from keras.optimizers import Adam
 from keras.regularizers import l2
 
-from models.utils import ValLoss, load_data, save_model_data, read_yaml
+from models.utils import ValLoss, SampleSequence, load_data, save_model_data, read_yaml
 
 os.environ['CUDA_VISIBLE_DEVICES'] = '0'
 
@@ -120,6 +120,7 @@ def get_args():
     parser.add_argument('-d', '--dir_name', type=str, default="dir_name")
     parser.add_argument('-c', '--config', type=str, default="./config/model.yml")
     parser.add_argument('-nc', '--no_context', action="store_true", default=False)
+    parser.add_argument('-w', '--workers', type=int, default=1)
 
     return parser.parse_args()
 
@@ -146,10 +147,11 @@ if __name__ == '__main__':
     tensorboard = TensorBoard(log_dir='./logs')
     early_stop = EarlyStopping(monitor='val_loss', patience=config['patience'])
     history = ValLoss(val, config['dataset'], config['dataset_path'], config['train_epochs'], True, config['eps_thres'],
-                      config['dominant_sets'])
+                      config['dominant_sets'], workers=args.workers, seed=args.seed)
 
-    model.fit(train[0], train[1], epochs=args.epochs, batch_size=config['batch_size'],
-              validation_data=(val[0], val[1]), callbacks=[tensorboard, early_stop, history])
+    model.fit(SampleSequence(train[0], train[1], config['batch_size'], shuffle=True), epochs=args.epochs,
+              validation_data=SampleSequence(val[0], val[1], config['batch_size']),
+              callbacks=[tensorboard, early_stop, history])
 
     no_context = "nc_" if args.no_context else ""
     dir_name = '{}_{}_{}/fold_{}/{}_{}{}'.format(
@@ -10,9 +10,11 @@ from keras.layers import Dense, Dropout, Conv2D, MaxPooling2D, Concatenate, Lamb
 from keras.models import Model
 from keras.optimizers import Adam
 from keras.regularizers import l2
+from keras.utils import Sequence
 
 from datasets.loader import read_obsmat, read_sim
-from models.DANTE.F1_calc import F1_calc, F1_calc_clone
+from models.DANTE.F1_calc import F1_calc, F1_calc_clone, get_evaluation_plan, create_evaluation_pool, \
+    close_evaluation_pool
 
 
 def read_yaml(file_path):
@@ -25,6 +27,139 @@ def load_pickle_file(file):
         return pickle.load(f)
 
 
+class IndexedArray:
+    """
+    Rows of an array selected by an index array, read only when sliced. Keras reads it through SampleSequence, so
+    training and prediction only read the batches they use.
+    """
+
+    def __init__(self, array, index):
+        self.array = array
+        self.index = index
+
+    @property
+    def shape(self):
+        return (len(self.index),) + self.array.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return np.asarray(self.array[(self.index[key[0]],) + key[1:]])
+        return np.asarray(self.array[self.index[key]])
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[:]
+        return array if dtype is None else array.astype(dtype)
+
+
+class SampleSequence(Sequence):
+    """
+    Batches of the inputs and labels of a split, given to Keras as real arrays.
+    """
+
+    def __init__(self, inputs, labels=None, batch_size=32, shuffle=False):
+        """
+        :param inputs: list of input arrays, ndarrays or IndexedArrays
+        :param labels: labels of the samples, None for prediction
+        :param batch_size: number of samples in a batch
+        :param shuffle: True to shuffle the samples every epoch, otherwise False
+        """
+        super().__init__()
+        self.inputs = inputs
+        self.labels = labels
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.order = np.arange(len(inputs[0]))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.order) / self.batch_size))
+
+    def __getitem__(self, i):
+        # sorted, so that memory mapped inputs are read in order
+        idx = np.sort(self.order[i * self.batch_size:(i + 1) * self.batch_size])
+        inputs = [np.asarray(array[idx]) for array in self.inputs]
+        # Keras unpacks a list batch as (x, y), so the inputs are wrapped in a tuple
+        if self.labels is None:
+            return (inputs,)
+        return inputs, np.asarray(self.labels[idx])
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.order = np.random.permutation(len(self.order))
+
+
+def get_frames_array(frames, pairs):
+    """
+    Rebuild the frames of a split, as an object array with the frames and the pair of every sample.
+    :param frames: frame ids of every sample
+    :param pairs: agent ids of the pair of every sample
+    :return: object array of shape (samples, 2)
+    """
+    frames_array = np.empty((len(frames), 2), dtype=object)
+    for i, (frame_ids, pair) in enumerate(zip(frames, pairs.tolist())):
+        frames_array[i, 0] = list(frame_ids)
+        frames_array[i, 1] = tuple(pair)
+    return frames_array
+
+
+def get_groups_list(samples, scenes):
+    """
+    Rebuild the groups of the given scenes, as a list with the frames and the groups of every scene.
+    :param samples: dictionary with the sample arrays of the dataset
+    :param scenes: indices of the scenes
+    :return: list of groups per scene
+    """
+    group_starts = np.concatenate(([0], np.cumsum(samples['groups_num'])))
+    agent_starts = np.concatenate(([0], np.cumsum(samples['group_sizes'])))
+    scenes_groups = np.empty((len(scenes), 2), dtype=object)
+    for i, scene in enumerate(scenes):
+        scenes_groups[i, 0] = list(samples['group_frames'][scene])
+        scenes_groups[i, 1] = [samples['group_agents'][agent_starts[group]:agent_starts[group + 1]].tolist()
+                               for group in range(group_starts[scene], group_starts[scene + 1])]
+    return list(scenes_groups)
+
+
+def load_samples(path):
+    """
+    Loads the samples of a dataset, with the data memory mapped.
+    :param path: string location of the samples folder
+    :return: dictionary with the sample arrays
+    """
+    samples = {}
+    for name in ['data', 'labels', 'frames', 'pairs', 'group_frames', 'groups_num', 'group_sizes', 'group_agents']:
+        samples[name] = np.load('{}/{}.npy'.format(path, name), mmap_mode='r' if name == 'data' else None)
+    return samples
+
+
+def load_split(samples, path, split):
+    """
+    Loads a split of a fold as views of the samples of the dataset.
+    :param samples: dictionary with the sample arrays of the dataset
+    :param path: string location of the fold
+    :param split: name of the split
+    :return: data, labels, frames and groups of the split
+    """
+    idx = np.load('{}/{}_samples.npy'.format(path, split))
+    groups_idx = np.load('{}/{}_groups.npy'.format(path, split))
+    data = samples['data']
+    samples_num, agents_num, frames_num, features = data.shape
+    if frames_num == 1:
+        # context and pair, in the layout of DANTE
+        data = data.reshape((samples_num, 1, agents_num, features))
+        data = [IndexedArray(data[:, :, 2:], idx), IndexedArray(data[:, :, :2], idx)]
+    else:
+        data = [IndexedArray(data[:, j], idx) for j in range(agents_num)]
+    frames = get_frames_array(samples['frames'][idx], samples['pairs'][idx])
+    return data, samples['labels'][idx], frames, get_groups_list(samples, groups_idx)
+
+
 def load_data(path, no_context=False):
     """
     Loads train, test and val sets
@@ -32,9 +167,15 @@ def load_data(path, no_context=False):
     :param no_context: True, if no context is used, otherwise False
     :return: train, test and val sets
     """
-    train = load_pickle_file(path + '/train.p')
-    test = load_pickle_file(path + '/test.p')
-    val = load_pickle_file(path + '/val.p')
+    if os.path.exists(path + '/train.p'):
+        train = load_pickle_file(path + '/train.p')
+        test = load_pickle_file(path + '/test.p')
+        val = load_pickle_file(path + '/val.p')
+    else:
+        samples = load_samples(os.path.dirname(os.path.normpath(path)) + '/samples')
+        train = load_split(samples, path, 'train')
+        test = load_split(samples, path, 'test')
+        val = load_split(samples, path, 'val')
     if no_context:
         train = (train[0][:2], train[1], train[2], train[3])
         test = (test[0][:2], test[1], test[2], test[3])
@@ -42,7 +183,8 @@ def load_data(path, no_context=False):
     return train, test, val
 
 
-def predict(data, model, groups, dataset, multi_frame=False, positions=None, eps_thres=1e-15, dominant_sets=True):
+def predict(data, model, groups, dataset, multi_frame=False, positions=None, eps_thres=1e-15, dominant_sets=True,
+            plan=None, evaluation_pool=None):
     """
     Gives T=1 and T=2/3 F1 scores.
     :param data: data to be used during prediction
@@ -53,6 +195,8 @@ def predict(data, model, groups, dataset, multi_frame=False, positions=None, eps
     :param positions: data in raw format
     :param eps_thres: threshold to be used in vector climb of dominant sets
     :param dominant_sets: True if dominant sets algorithm will be used, otherwise False
+    :param plan: evaluation plan of the data from get_evaluation_plan, computed if not given
+    :param evaluation_pool: evaluation pool from create_evaluation_pool to evaluate the scenes with
     :return: T=1 and T=2/3 F1 scores
     """
     if "cocktail_party" in dataset:
@@ -60,7 +204,7 @@ def predict(data, model, groups, dataset, multi_frame=False, positions=None, eps
         n_features = 4
 
         X, y, frames = data
-        predictions = model.predict(X)
+        predictions = model.predict(SampleSequence(X))
 
         return F1_calc([2 / 3, 1], predictions, frames, groups, positions, n_people, n_features, eps_thres=eps_thres)
     else:
@@ -71,10 +215,11 @@ def predict(data, model, groups, dataset, multi_frame=False, positions=None, eps
             raise Exception("unknown dataset")
 
     X, y, frames, groups = data
-    predictions = model.predict(X)
+    predictions = model.predict(SampleSequence(X))
 
     return F1_calc_clone([2 / 3, 1, None], predictions, frames, groups, positions, multi_frame=multi_frame,
-                         eps_thres=eps_thres, dominant_sets=dominant_sets)
+                         eps_thres=eps_thres, dominant_sets=dominant_sets, plan=plan,
+                         evaluation_pool=evaluation_pool)
 
 
 # generates feature and ground-truth group matrices from data files
@@ -113,7 +258,7 @@ class ValLoss(Callback):
     """
 
     def __init__(self, val_data, dataset, dataset_path, train_epochs=0, multi_frame=False, eps_thres=1e-15,
-                 dominant_sets=True):
+                 dominant_sets=True, workers=1, seed=0):
         super(ValLoss, self).__init__()
         self.val_data = val_data
         self.dataset = dataset
@@ -123,6 +268,8 @@ class ValLoss(Callback):
         self.eps_thres = eps_thres
         self.dominant_sets = dominant_sets
 
+        self.plan = None
+        self.evaluation_pool = None
         # each dataset has different params and possibly different F1 calc code
         if dataset in ["cocktail_party"]:
             self.positions, groups = import_data(dataset_path)
@@ -132,13 +279,18 @@ class ValLoss(Callback):
             if "_shifted" in dataset_name:
                 dataset_name = dataset_name.replace("_shifted", "")
             if "sim_" in dataset_name:
-                self.positions = read_sim(dataset_path, 50)
+                self.positions = read_sim(dataset_path, 50, columnar=True)
                 self.groups = val_data[3]
             elif dataset_name in ["eth", "hotel", "zara01", "zara02", "students03"]:
-                self.positions = read_obsmat(dataset_path)
+                self.positions = read_obsmat(dataset_path, columnar=True)
                 self.groups = val_data[3]
             else:
                 raise Exception("unrecognized dataset")
+            # scenes, agents and ground truth groups of the validation samples do not change between epochs
+            self.plan = get_evaluation_plan(val_data[2], self.groups, self.positions, multi_frame)
+            # scenes are clustered in chunks with dominant sets seeded per scene, so that results do not depend on
+            # the number of workers
+            self.evaluation_pool = create_evaluation_pool(self.plan, len(val_data[1]), workers, seed)
 
         self.best_model = None
         self.best_val_mse = float("inf")
@@ -158,6 +310,11 @@ class ValLoss(Callback):
         self.val_mses = []
         self.train_mses = []
 
+    def on_train_end(self, logs=None):
+        if self.evaluation_pool is not None:
+            close_evaluation_pool(self.evaluation_pool)
+            self.evaluation_pool = None
+
     def on_epoch_end(self, epoch, logs=None):
         if logs is None:
             logs = {}
@@ -170,7 +327,7 @@ class ValLoss(Callback):
             self.best_epoch = epoch
 
         results = predict(self.val_data, self.model, self.groups, self.dataset, self.multi_frame, self.positions,
-                          self.eps_thres, self.dominant_sets)
+                          self.eps_thres, self.dominant_sets, self.plan, self.evaluation_pool)
 
         avg = 0
         objs = [self.val_f1_two_thirds_obj, self.val_f1_one_obj, self.val_f1_gmitre_obj]
@@ -418,7 +575,7 @@ def train_and_save_model(global_filters, individual_filters, combined_filters,
     early_stop = EarlyStopping(monitor='val_loss', patience=patience)
     history = ValLoss(val, dataset, dataset_path, eps_thres=eps_thres)
 
-    model.fit(train[0], train[1], epochs=epochs, batch_size=batch_size,
-              validation_data=(val[0], val[1]), callbacks=[tensorboard, history, early_stop])
+    model.fit(SampleSequence(train[0], train[1], batch_size, shuffle=True), epochs=epochs,
+              validation_data=SampleSequence(val[0], val[1], batch_size), callbacks=[tensorboard, history, early_stop])
 
     save_model_data(dir_name, reg, dropout, history, test, eps_thres=eps_thres)